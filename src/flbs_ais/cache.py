@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from contextlib import contextmanager
+
+
+DEFAULT_PATH      = os.path.join(os.path.expanduser('~'), '.cache', 'flbs_ais', 'nas_api.sqlite')
+DEFAULT_TTL       = 24 * 60 * 60
+DEFAULT_MAX_BYTES = 512 * 2**20
+
+# Parameters that don't change a response and must not be stored
+_IGNORED_PARAMS = ('api_key',)
+
+_settings = {'path': None, 'ttl': DEFAULT_TTL, 'max_bytes': DEFAULT_MAX_BYTES, 'offline': False}
+_lock = threading.Lock()
+
+
+def enable(path=DEFAULT_PATH, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+    """Caches NAS API responses in a SQLite file at path. Responses older than ttl seconds are fetched again, and the least
+    recently used responses are evicted when the compressed total is over max_bytes. In offline mode only cached responses are used."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    _settings.update(path=path, ttl=ttl, max_bytes=max_bytes, offline=offline)
+    with _connect() as connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, body BLOB, '
+                           'size INTEGER, created REAL, accessed REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+
+def disable():
+    """Stops caching NAS API responses, the cache file is kept"""
+    _settings['path'] = None
+    _settings['offline'] = False
+
+
+def is_enabled():
+    return _settings['path'] is not None
+
+
+def is_offline():
+    return is_enabled() and _settings['offline']
+
+
+def get(url, params):
+    """Returns the cached JSON response for a request, or None if there is no fresh cached response"""
+    key = _get_key(url, params)
+    now = time.time()
+    with _lock, _connect() as connection:
+        row = connection.execute('SELECT body, created FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if _settings['ttl'] is not None and now - row[1] > _settings['ttl'] and not _settings['offline']:
+            connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            return None
+        connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+    return json.loads(zlib.decompress(row[0]))
+
+
+def put(url, params, response_json):
+    """Stores the JSON response for a request, evicting least recently used responses if the cache is over its size limit"""
+    key = _get_key(url, params)
+    body = zlib.compress(json.dumps(response_json).encode())
+    now = time.time()
+    with _lock, _connect() as connection:
+        connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (key, url, body, len(body), now, now))
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total > _settings['max_bytes']:
+            rows = connection.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall()
+            evicted = []
+            for row_key, size in rows:
+                if total <= _settings['max_bytes']:
+                    break
+                evicted.append((row_key,))
+                total -= size
+            connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+
+def clear():
+    """Removes every cached response"""
+    with _lock, _connect() as connection:
+        connection.execute('DELETE FROM responses')
+
+
+def _get_key(url, params):
+    """Returns a cache key for an endpoint and its parameters, leaving out parameters such as the API key"""
+    kept = sorted((name, str(value)) for name, value in params.items() if name not in _IGNORED_PARAMS)
+    return hashlib.sha256(json.dumps([url, kept]).encode()).hexdigest()
+
+
+@contextmanager
+def _connect():
+    """Yields a SQLite connection to the cache file that commits, or rolls back on errors, and closes afterwards"""
+    if _settings['path'] is None:
+        raise ValueError("Cache is not enabled - Call cache.enable() first")
+    connection = sqlite3.connect(_settings['path'], timeout=30)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
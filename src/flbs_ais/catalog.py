@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import bisect
+import gzip
+import json
+import os
+import threading
+import time
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'flbs_ais', 'species.json.gz')
+
+# Fields that can be looked up by value, species IDs are looked up separately
+FIELDS = ('genus', 'species', 'common_name')
+
+_settings = {'path': DEFAULT_PATH}
+_catalogs = {}
+_lock = threading.Lock()
+
+
+class Catalog:
+    """In-memory index of a snapshot of the NAS species list. Each field in FIELDS is kept as sorted values, as given and
+    lower case, so exact and prefix lookups are binary searches"""
+
+    def __init__(self, records, downloaded=None):
+        self.records = records
+        self.downloaded = downloaded
+        self._ids = {}
+        for position, record in enumerate(records):
+            self._ids.setdefault(str(record.get('speciesID')), []).append(position)
+        self._sorted = {}
+        for field in FIELDS:
+            for ignore_case in (False, True):
+                values = [(_text(record.get(field), ignore_case), position) for position, record in enumerate(records)]
+                values.sort()
+                self._sorted[field, ignore_case] = ([value for value, position in values],
+                                                    [position for value, position in values])
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, genus=None, species=None, common_name=None, species_id=None, prefix=False, ignore_case=False):
+        """Returns copies of the species records matching every value given, in catalog order. With prefix, values match
+        the start of a field, and with ignore_case, the case of values is ignored"""
+        positions = None
+        if species_id is not None:
+            positions = set(self._ids.get(str(species_id), ()))
+        for field, value in zip(FIELDS, (genus, species, common_name)):
+            if value is None:
+                continue
+            values, field_positions = self._sorted[field, ignore_case]
+            value = _text(value, ignore_case)
+            start = bisect.bisect_left(values, value)
+            end = bisect.bisect_left(values, value + '\U0010ffff') if prefix else bisect.bisect_right(values, value)
+            matches = set(field_positions[start:end])
+            positions = matches if positions is None else positions & matches
+        if positions is None:
+            positions = range(len(self.records))
+        return [dict(self.records[position]) for position in sorted(positions)]
+
+
+def set_path(path=DEFAULT_PATH):
+    """Keeps the species catalog snapshot in the file at path"""
+    _settings['path'] = path
+
+
+def load(path=None):
+    """Returns the Catalog of the snapshot at path, read once and then kept in memory, or None if there is no snapshot"""
+    path = path or _settings['path']
+    with _lock:
+        if path not in _catalogs:
+            if not os.path.exists(path):
+                return None
+            with gzip.open(path, 'rt', encoding='utf-8') as snapshot:
+                content = json.load(snapshot)
+            _catalogs[path] = Catalog(content['results'], content.get('downloaded'))
+        return _catalogs[path]
+
+
+def save(records, path=None):
+    """Writes records as the snapshot at path, replacing any snapshot there, and returns its Catalog"""
+    path = path or _settings['path']
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    downloaded = time.time()
+    # Written to a temporary file first, so readers never see a partial snapshot
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(temporary, 'wt', encoding='utf-8') as snapshot:
+        json.dump({'downloaded': downloaded, 'results': records}, snapshot)
+    os.replace(temporary, path)
+    with _lock:
+        _catalogs[path] = Catalog(records, downloaded)
+        return _catalogs[path]
+
+
+def _text(value, ignore_case):
+    value = '' if value is None else str(value)
+    return value.lower() if ignore_case else value
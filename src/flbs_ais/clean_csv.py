@@ -4,14 +4,23 @@ import numpy as np
 import pandas as pd
 
 
-def _rename_year(df):
+# Years given to the truncated 'system:index' values, in the order the values first appear
+_YEARS = list(range(2002,2014)) + list(range(2015,2017))
+
+
+def _rename_year(df, years=None):
+    """Returns df with 'system:index' replaced by years. years maps truncated index values to their year and is extended
+    with new values, so chunks of one file passed the same dict get the same years"""
     if 'system:index' in df:
+        if years is None:
+            years = {}
         # Remove after character 10 to remove uniqueness
-        df['system:index'] = df['system:index'].map(lambda x: str(x)[:10])
-        uniques = df['system:index'].unique()
-        years = list(range(2002,2014)) + list(range(2015,2017))
-        dates = {u : y for (u,y) in zip(uniques,years)}
-        df['system:index'] = df['system:index'].replace(dates)
+        index = df['system:index'].astype(str).str[:10]
+        for value in index.unique():
+            if value not in years and len(years) < len(_YEARS):
+                years[value] = _YEARS[len(years)]
+        renamed = index.map(years)
+        df['system:index'] = renamed.fillna(index) if renamed.isna().any() else renamed
     return df
 
 
@@ -29,52 +38,71 @@ def _manage_columns(df, drop_list, name_dict):
     return df
 
 
-def clean_csv(filename, output='df', drop_columns=[], keep_columns=[], split_columns=[], rename_columns={}, rename_year=True):
+def clean_csv(filename, output='df', drop_columns=[], keep_columns=[], split_columns=[], rename_columns={}, rename_year=True,
+              chunksize=None):
+    """Returns or writes cleaned versions of an Earth Engine CSV export, one without each of split_columns or a single clean one.
+    If chunksize is given, the file is read chunksize rows at a time and each chunk is appended to every output file, so
+    output='csv' runs in bounded memory"""
     df_dict = {}
     drop_list = []
     filename_left = filename[:filename.rfind('.')]
-    csv_df = pd.read_csv(filename)
+    columns = list(pd.read_csv(filename, nrows=0).columns)
 
     if output not in ['csv', 'df']:
         raise ValueError(f"Output value '{output}' is invalid - Options are 'csv' and 'df'")
 
     if drop_columns and keep_columns:
-        if list(csv_df.columns) != drop_columns + keep_columns:
+        if columns != drop_columns + keep_columns:
             drop_list = drop_columns
         else:
             raise ValueError(f"Drop column list and keep column list do not combine to make set of all columns")
     elif drop_columns:
         drop_list = drop_columns
     elif keep_columns:
-        drop_list = np.setdiff1d(list(csv_df.columns), keep_columns)
-    
+        drop_list = np.setdiff1d(columns, keep_columns)
+
     # Renaming: Check if keeping a renamed column
     for column in keep_columns:
         for item in list(rename_columns.items()):
             if column == item[1]:
                 drop_list = np.delete(drop_list, np.where(drop_list == item[0]))
 
-    if rename_year:
-        csv_df = _rename_year(csv_df)
-
-    csv_df = _manage_columns(csv_df, drop_list, rename_columns)
-
+    # Each output file and the column it leaves out, checked against the cleaned header before reading any rows
+    clean_columns = _manage_columns(pd.DataFrame(columns=columns), drop_list, rename_columns).columns
     if split_columns:
         for column in split_columns:
-            if column in df_out:
+            if column in clean_columns:
                 # using renamed column
-                df_out = csv_df.drop(column, axis=1)
+                df_dict[f"{filename_left}_{column}.csv"] = column
             elif column in list(rename_columns.keys()):
                 # using original column
-                df_out = csv_df.drop(rename_columns[column], axis=1)
+                df_dict[f"{filename_left}_{column}.csv"] = rename_columns[column]
             else:
                 raise ValueError(f"Can't split dataframe by column '{column}' - Does not exist in dataframe")
-            df_dict[f"{filename_left}_{column}.csv"] = df_out
     else:
-        df_dict[f"{filename_left}_clean.csv"] = csv_df
-    
-    if output == 'csv':
-        for key in list(df_dict.keys()):
-            df_dict[key].to_csv(key, index=False)
+        df_dict[f"{filename_left}_clean.csv"] = None
+
+    # Dropped columns are left out by the reader, so they are never parsed
+    dropped = set(drop_list)
+    usecols = [column for column in columns if column not in dropped]
+    if chunksize is not None:
+        reader = pd.read_csv(filename, usecols=usecols, chunksize=chunksize)
     else:
-        return df_dict
+        reader = [pd.read_csv(filename, usecols=usecols)]
+
+    years = {}
+    chunks = {key: [] for key in df_dict}
+    for i, csv_df in enumerate(reader):
+        if rename_year:
+            csv_df = _rename_year(csv_df, years)
+        csv_df = _manage_columns(csv_df, [], rename_columns)
+
+        for key, column in df_dict.items():
+            df_out = csv_df.drop(column, axis=1) if column is not None else csv_df
+            if output == 'csv':
+                df_out.to_csv(key, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            else:
+                chunks[key].append(df_out)
+
+    if output == 'df':
+        return {key: pd.concat(dfs, ignore_index=True) for key, dfs in chunks.items()}
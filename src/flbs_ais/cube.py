@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+
+
+# Number of digits in the codes of each HUC level, a HUC code starts with the code of every HUC containing it
+HUC_DIGITS = {'huc8': 8, 'huc10': 10, 'huc12': 12}
+
+
+class HucCube:
+    """Counts of occurrence records by HUC, year and status, from a dataframe from csv_df or api_df. counts is an array of
+    shape (len(hucs), len(years), len(statuses)) and each axis is labelled by a sorted array of the values seen. Records
+    without a HUC at the cube's level, a year or a status are not counted"""
+
+    def __init__(self, df=None, level='huc12'):
+        if level not in HUC_DIGITS:
+            raise ValueError(f"Invalid parameter for level '{level}' - Accepted values are {', '.join(HUC_DIGITS)}")
+        self.level = level
+        self.hucs = np.empty(0, dtype=np.int64)
+        self.years = np.empty(0, dtype=np.int64)
+        self.statuses = np.empty(0, dtype=object)
+        self.counts = np.zeros((0, 0, 0), dtype=np.int64)
+        if df is not None:
+            self.add(df)
+
+    def __len__(self):
+        """Returns the number of records counted"""
+        return int(self.counts.sum())
+
+    def add(self, df):
+        """Counts the records of df into the cube, growing its axes for HUCs, years and statuses it has not seen"""
+        # Each column is factorized first, so only its distinct values are sorted into the axes
+        codes, values = zip(*(pd.factorize(df[column]) for column in (self.level, 'year', 'status')))
+        counted = (codes[0] >= 0) & (codes[1] >= 0) & (codes[2] >= 0)
+        if not counted.any():
+            return
+        values = (np.asarray(values[0], dtype=np.int64), np.asarray(values[1], dtype=np.int64),
+                  np.asarray(values[2], dtype=str).astype(object))
+        self._grow(*values)
+        positions = [np.searchsorted(labels, value)[code[counted]] for labels, value, code in
+                     zip((self.hucs, self.years, self.statuses), values, codes)]
+        shape = self.counts.shape
+        self.counts += np.bincount(np.ravel_multi_index(positions, shape), minlength=self.counts.size).reshape(shape)
+
+    def rollup(self, level):
+        """Returns a cube of the same records counted by the larger HUCs of level, which contain the cube's HUCs"""
+        if level not in HUC_DIGITS or HUC_DIGITS[level] > HUC_DIGITS[self.level]:
+            raise ValueError(f"Can't roll up '{self.level}' to '{level}' - Accepted levels are "
+                             f"{', '.join(name for name, digits in HUC_DIGITS.items() if digits <= HUC_DIGITS[self.level])}")
+        hucs, inverse = np.unique(self.hucs // 10 ** (HUC_DIGITS[self.level] - HUC_DIGITS[level]), return_inverse=True)
+        counts = np.zeros((len(hucs),) + self.counts.shape[1:], dtype=self.counts.dtype)
+        np.add.at(counts, inverse, self.counts)
+        return self._with(level, hucs, self.years, self.statuses, counts)
+
+    def select(self, huc=None, year=None, status=None):
+        """Returns the cube sliced to some HUCs, years and statuses. Each one is None for all, a value, a list of values or a
+        slice of values including both ends, as with DataFrame.loc. Values the cube has not seen are left out"""
+        positions = [_positions(labels, selector) for labels, selector in
+                     ((self.hucs, huc), (self.years, year), (self.statuses, status))]
+        counts = self.counts[np.ix_(*positions)]
+        return self._with(self.level, self.hucs[positions[0]], self.years[positions[1]], self.statuses[positions[2]], counts)
+
+    def count(self, huc=None, year=None, status=None):
+        """Returns the number of records for some HUCs, years and statuses, selected as in select()"""
+        return len(self.select(huc, year, status))
+
+    def to_series(self, by=('huc', 'year', 'status')):
+        """Returns the non-zero counts summed over the axes not in by, as a groupby(...).size() of the records would.
+        by is one or more of 'huc', 'year' and 'status', and the huc level is named after the cube's level"""
+        axes = ('huc', 'year', 'status')
+        by = [by] if isinstance(by, str) else list(by)
+        for name in by:
+            if name not in axes:
+                raise ValueError(f"Invalid parameter for by '{name}' - Accepted values are {', '.join(axes)}")
+        order = [axes.index(name) for name in by]
+        counts = self.counts.sum(axis=tuple(axis for axis in range(3) if axis not in order))
+        counts = counts.transpose(np.argsort(np.argsort(order)))
+        labels = [(self.hucs, self.years, self.statuses)[axis] for axis in order]
+        names = [self.level if name == 'huc' else name for name in by]
+        index = pd.MultiIndex.from_product(labels, names=names) if len(labels) > 1 else pd.Index(labels[0], name=names[0])
+        series = pd.Series(counts.ravel(), index=index, name='count')
+        return series[series > 0]
+
+    def _grow(self, hucs, years, statuses):
+        """Adds new labels to the axes, keeping the counts of the labels already there"""
+        grown = [np.union1d(old, new).astype(old.dtype) for old, new in ((self.hucs, hucs), (self.years, years), (self.statuses, statuses))]
+        if all(len(new) == len(old) for new, old in zip(grown, (self.hucs, self.years, self.statuses))):
+            return
+        counts = np.zeros(tuple(len(labels) for labels in grown), dtype=self.counts.dtype)
+        counts[np.ix_(*(np.searchsorted(new, old) for new, old in zip(grown, (self.hucs, self.years, self.statuses))))] = \
+            self.counts
+        self.hucs, self.years, self.statuses = grown
+        self.counts = counts
+
+    @classmethod
+    def _with(cls, level, hucs, years, statuses, counts):
+        cube = cls(level=level)
+        cube.hucs, cube.years, cube.statuses, cube.counts = hucs, years, statuses, counts
+        return cube
+
+
+def _positions(labels, selector):
+    """Returns the positions in sorted labels of the values picked by selector, which is None, a value, a list or a slice"""
+    if selector is None:
+        return np.arange(len(labels))
+    if isinstance(selector, slice):
+        start = 0 if selector.start is None else np.searchsorted(labels, selector.start, side='left')
+        stop = len(labels) if selector.stop is None else np.searchsorted(labels, selector.stop, side='right')
+        return np.arange(start, stop)
+    values = np.asarray([selector] if np.ndim(selector) == 0 else selector, dtype=labels.dtype)
+    positions = np.clip(np.searchsorted(labels, values), 0, max(len(labels) - 1, 0))
+    return np.unique(positions[labels[positions] == values]) if len(labels) else positions[:0]
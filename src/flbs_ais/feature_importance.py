@@ -1,45 +1,280 @@
 #!/usr/bin/env python3
+import hashlib
 import sys
 
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 
 ##from flbs_ais.drop_collinear import drop_collinear
+from pandas.api.types import is_numeric_dtype
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+from sklearn.metrics import f1_score, r2_score
 from sklearn.model_selection import train_test_split
-from rfpimp import feature_dependence_matrix
+from sklearn.preprocessing import LabelEncoder
+
+
+# Dependence rows already computed, keyed by target column, the other columns, their data and the settings
+_dependence_cache = {}
+
+# Training data of a worker process of feature_dependence_matrix, sent once to each process instead of with every row
+_worker_X_train = None
+
 
+# Dependence estimators for method=, from exact to cheapest
+METHODS = ('exact', 'subsample', 'forest', 'linear')
 
 
-def _get_partial_dependencies(X, y, threshold, test_size=0.2, random_state=1):
+def _get_partial_dependencies(X, y, threshold, test_size=0.2, random_state=1, workers=None, method='exact', fraction=0.1,
+                              n_estimators=10, confirm=False):
+    """Returns pairs of features with a dependence at or above threshold, strongest first. method is 'exact', 'subsample' to
+    train on a fraction of the rows, 'forest' to train forests of n_estimators trees, or 'linear' for squared multiple
+    correlations. With confirm, features in the pairs found are checked again with the exact method."""
     X_train = train_test_split(X, y, test_size=test_size, random_state=random_state)[0]
-    df = feature_dependence_matrix(X_train)
+    df = _get_pairs(_get_dependence_matrix(X_train, method, fraction, n_estimators, random_state, workers), threshold)
+
+    if confirm and method != 'exact':
+        df = _confirm_pairs(X_train, df, threshold, random_state, workers)
+    return df
+
+
+def _confirm_pairs(X_train, df, threshold, random_state, workers):
+    """Returns the pairs of df that are still at or above threshold with the exact method, with their exact dependence"""
+    if df.empty:
+        return df
+    # Only pairs found by the cheap estimator are kept, with their exact dependence
+    features = set(df['index']) | set(df['variable'])
+    exact = _get_pairs(feature_dependence_matrix(X_train, random_state=random_state, workers=workers, features=features), threshold)
+    found = set(map(frozenset, zip(df['index'], df['variable'])))
+    return exact[[frozenset(pair) in found for pair in zip(exact['index'], exact['variable'])]].reset_index(drop=True)
+
+
+def _get_pairs(df, threshold):
+    """Returns pairs of features with a dependence at or above threshold in a dependence matrix, strongest first"""
 
     # Drop dependence column
     df = df.drop(columns='Dependence')
+    names = df.index.values
+    values = df.to_numpy(dtype=float)
 
-    # Replace self relationships with NaN
-    df = df.mask(df == 1)
+    # Each pair keeps the stronger direction, so the upper triangle holds every pair once without self relationships
+    stronger = np.nan_to_num(values, nan=-np.inf) >= np.nan_to_num(values.T, nan=-np.inf)
+    values = np.fmax(values, values.T)
+    rows, cols = np.triu_indices(len(names), k=1)
+    pair_values = values[rows, cols]
+    selected = pair_values >= threshold
+    rows, cols, pair_values = rows[selected], cols[selected], pair_values[selected]
 
-    # Mask all cells less than threshold
-    df = df.mask(df < threshold)
+    # Orient each pair as dependent feature then the feature it depends on, strongest pairs first
+    forward = stronger[rows, cols]
+    order = np.argsort(-pair_values, kind='stable')
+    return pd.DataFrame({'index': np.where(forward, names[rows], names[cols])[order],
+                         'variable': np.where(forward, names[cols], names[rows])[order],
+                         'value': pair_values[order]})
 
-    # Melt table to get relationships of each row to each column in pairs
-    df = df.reset_index().melt(id_vars='index')
 
-    # Take advantage of fact that NaN != NaN to find non-NaN values in table
-    df = df.query('value == value')
+def _get_dependence_matrix(X_train, method, fraction, n_estimators, random_state, workers, features=None):
+    """Returns a dependence matrix like feature_dependence_matrix, computed with one of METHODS"""
+    if method not in METHODS:
+        raise ValueError(f"Invalid parameter for method '{method}' - Accepted values are {', '.join(map(repr, METHODS))}")
+    if method == 'linear':
+        return linear_dependence_matrix(X_train)
+    options = {'random_state': random_state, 'workers': workers, 'features': features}
+    if method == 'subsample':
+        options['n_samples'] = min(5000, max(1, round(len(X_train) * fraction)))
+    elif method == 'forest':
+        options['n_estimators'] = n_estimators
+    return feature_dependence_matrix(X_train, **options)
+
+
+def linear_dependence_matrix(X_train):
+    """Returns a dependence matrix laid out like feature_dependence_matrix from linear regressions, using one inverse of the
+    correlation matrix. Dependence is the squared multiple correlation of each feature with the others, and each cell is the
+    loss in that R^2 when the column's feature is left out of the regression of the row's feature."""
+    numeric_cols = [col for col in X_train if is_numeric_dtype(X_train[col])]
+    corr = np.atleast_2d(np.corrcoef(X_train[numeric_cols].to_numpy(dtype=float), rowvar=False))
+
+    # Constant columns have no correlation with anything
+    corr = np.nan_to_num(corr)
+    np.fill_diagonal(corr, 1.0)
+    precision = np.linalg.pinv(corr)
+    diagonal = np.diag(precision)
+
+    # Leaving feature j out of the regression of feature i loses P_ij^2 / (P_ii (P_ii P_jj - P_ij^2)) of its R^2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dependence = 1 - 1 / diagonal
+        loss = precision ** 2 / (diagonal[:, None] * (np.outer(diagonal, diagonal) - precision ** 2))
+    loss = np.clip(np.nan_to_num(loss, nan=1.0, posinf=1.0), 0.0, 1.0)
+    np.fill_diagonal(loss, 1.0)
+
+    df_dep = pd.DataFrame(index=X_train.columns, columns=['Dependence'] + X_train.columns.tolist(), dtype=float)
+    df_dep.loc[numeric_cols, 'Dependence'] = np.clip(dependence, 0.0, 1.0)
+    df_dep.loc[numeric_cols, numeric_cols] = loss
+    return df_dep
+
+
+def feature_dependence_matrix(X_train, n_estimators=50, cat_count=20, zero=0.001, n_samples=5000, random_state=1, workers=None,
+                              features=None):
+    """Returns the dependence matrix of rfpimp.feature_dependence_matrix, training the random forest of each feature in its own
+    process on up to workers processes. Out-of-bag scores are computed here, since rfpimp's no longer work with scikit-learn.
+    Every column is an input to each row's forest, so rows are cached by feature and a fingerprint of the data of every column.
+    The cache serves repeated calls on the same columns, after dropping a feature use _drop_features, which only computes the
+    rows that depended on it. Sampling and forests are seeded with random_state. If features is given, only their rows are computed."""
+    X_train = X_train.copy()
+    numeric_cols = [col for col in X_train if is_numeric_dtype(X_train[col])]
+    cat_cols = [col for col in numeric_cols if X_train[col].value_counts().count() <= cat_count]
+    for col in cat_cols:
+        if X_train[col].dtypes == 'float':
+            X_train[col] = LabelEncoder().fit_transform(X_train[col])
+
+    rng = np.random.RandomState(random_state)
+    if 0 <= n_samples < len(X_train):
+        X_train = X_train.iloc[rng.choice(len(X_train), n_samples)]
+
+    # One fingerprint per column, so a key only changes when its own columns change
+    fingerprints = {col: hashlib.sha1(pd.util.hash_pandas_object(X_train[col]).values.tobytes()).hexdigest() for col in X_train}
+    settings = (n_estimators, cat_count, zero, n_samples, random_state)
+    if features is not None:
+        numeric_cols = [col for col in numeric_cols if col in features]
+    keys = {col: (col, tuple(fingerprints.items()), settings) for col in numeric_cols}
+
+    missing = [col for col in numeric_cols if keys[col] not in _dependence_cache]
+    jobs = [(col, col in cat_cols, n_estimators, zero, n_samples, random_state) for col in missing]
+    if len(jobs) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_set_worker_data, initargs=(X_train,)) as executor:
+            rows = list(executor.map(_get_worker_row, *zip(*jobs)))
+    else:
+        rows = [_get_dependence_row(X_train, *job) for job in jobs]
+    _dependence_cache.update(zip((keys[col] for col in missing), rows))
+
+    df_dep = pd.DataFrame(index=X_train.columns, columns=['Dependence'] + X_train.columns.tolist())
+    for col in numeric_cols:
+        df_dep.loc[col] = _dependence_cache[keys[col]]
+    return df_dep
+
+
+def _set_worker_data(X_train):
+    global _worker_X_train
+    _worker_X_train = X_train
+
+
+def _get_worker_row(col, is_cat, n_estimators, zero, n_samples, random_state):
+    """Returns a dependence row in a worker process, from the training data the process was started with"""
+    return _get_dependence_row(_worker_X_train, col, is_cat, n_estimators, zero, n_samples, random_state)
+
+
+def _drop_features(X_train, matrix, dropped, method, fraction, n_estimators, random_state, workers):
+    """Returns a dependence matrix without the dropped features, for X_train without them. Only the rows of features that
+    depended on a dropped feature are computed again, the other rows are kept"""
+    kept = [name for name in matrix.index if name not in dropped]
+    affected = [name for name in kept if (matrix.loc[name, list(dropped)].to_numpy(dtype=float) > 0).any()]
+    matrix = matrix.loc[kept, ['Dependence'] + kept].copy()
+    if affected:
+        update = _get_dependence_matrix(X_train[kept], method, fraction, n_estimators, random_state, workers,
+                                        features=set(affected))
+        matrix.loc[affected] = update.loc[affected, matrix.columns]
+    return matrix
+
+
+def _get_dependence_row(X_train, col, is_cat, n_estimators, zero, n_samples, random_state):
+    """Returns the overall dependence of a feature on the others followed by the importance of each column to it"""
+    rng = np.random.RandomState(random_state)
+    X, y = X_train.drop(col, axis=1).values, X_train[col].values
+    if is_cat:
+        rf = RandomForestClassifier(n_estimators=n_estimators, oob_score=True, random_state=random_state)
+    else:
+        rf = RandomForestRegressor(n_estimators=n_estimators, oob_score=True, random_state=random_state)
+    rf.fit(X, y)
+
+    # Permutation importance on out-of-bag rows, as rfpimp.permutation_importances_raw
+    oob_indices = [np.flatnonzero(np.bincount(rows, minlength=len(X)) == 0) for rows in rf.estimators_samples_]
+    baseline = _oob_score(rf, X, y, oob_indices, is_cat)
+    imp = []
+    for i in range(X.shape[1]):
+        save = X[:, i].copy()
+        X[:, i] = rng.permutation(save)
+        imp.append(baseline - _oob_score(rf, X, y, oob_indices, is_cat))
+        X[:, i] = save
+    imp = np.array(imp)
+
+    # As in rfpimp, importances are clipped to [0, 1] and the feature depends fully on itself
+    imp = np.clip(imp, a_min=0.0, a_max=1.0)
+    imp[imp < zero] = 0.0
+    imp = np.insert(imp, X_train.columns.get_loc(col), 1.0)
+    return np.insert(imp, 0, rf.oob_score_)
 
-    # Drop rows that are reverse duplicates of other rows
-    if not df.empty:
-        check_string_list = []
-        for row in df.itertuples():
-            string = ''.join(sorted([row[1], row[2]]))
-            check_string_list.append(string)
-        df.insert(3, "check_string", check_string_list)
-        df = df.drop_duplicates('check_string')
-        df = df.drop('check_string', axis=1)
-    
-    return df
+
+def _oob_score(rf, X, y, oob_indices, is_cat):
+    """Returns the out-of-bag macro F1 score of a classifier or R^2 of a regressor, as rfpimp's oob_*_score functions"""
+    if is_cat:
+        predictions = np.zeros((len(X), len(rf.classes_)))
+        for tree, rows in zip(rf.estimators_, oob_indices):
+            predictions[rows] += tree.predict_proba(X[rows])
+        return f1_score(y, rf.classes_[predictions.argmax(axis=1)], average='macro')
+
+    predictions = np.zeros(len(X))
+    counts = np.zeros(len(X))
+    for tree, rows in zip(rf.estimators_, oob_indices):
+        predictions[rows] += tree.predict(X[rows])
+        counts[rows] += 1
+    counts[counts == 0] = 1
+    return r2_score(y, predictions / counts)
+
+
+def prune_dependencies(X, y, threshold, strategy='highest', test_size=0.2, random_state=1, workers=None, method='exact',
+                       fraction=0.1, n_estimators=10, confirm=False):
+    """Returns X without features that depend on other features at or above threshold, and a dataframe of the dropped features
+    in the order they were dropped, with the feature each depended on most, that dependence and the number of dependent pairs
+    it was in. The 'highest' strategy drops the feature with the highest dependence first, 'coverage' drops the feature in the
+    most dependent pairs first. The dependence matrix is built once, and after each drop only the rows of features that used
+    the dropped feature are computed again. method, fraction and n_estimators choose the estimator as in _get_partial_dependencies.
+    With confirm, the rows of a feature and its partner are computed again with the exact method before the feature is dropped."""
+    if strategy not in ('highest', 'coverage'):
+        raise ValueError(f"Invalid parameter for strategy '{strategy}' - Accepted values are 'highest', 'coverage'")
+
+    X_train = train_test_split(X, y, test_size=test_size, random_state=random_state)[0]
+    matrix = _get_dependence_matrix(X_train, method, fraction, n_estimators, random_state, workers)
+
+    dropped = []
+    confirmed = set()
+    while True:
+        names = np.array(matrix.index)
+        values = matrix.drop(columns='Dependence').to_numpy(dtype=float)
+        np.fill_diagonal(values, np.nan)
+
+        # NaN is never at or above threshold
+        above = values >= threshold
+        if not above.any():
+            break
+        scores = np.where(above, values, -np.inf)
+        pairs = above.sum(axis=1) + above.sum(axis=0)
+        best = np.maximum(scores.max(axis=1), scores.max(axis=0))
+        if strategy == 'highest':
+            drop = np.argmax(scores.max(axis=1))
+        else:
+            drop = np.lexsort((-best, -pairs))[0]
+
+        # Partner is the feature in the drop's highest pair, whichever side of the pair it is on
+        row, col = scores[drop], scores[:, drop]
+        partner = np.argmax(row) if row.max() >= col.max() else np.argmax(col)
+
+        # Rows found by a cheap estimator are replaced by exact ones, then the feature to drop is chosen again
+        unconfirmed = [name for name in (names[drop], names[partner]) if name not in confirmed]
+        if confirm and method != 'exact' and unconfirmed:
+            exact = feature_dependence_matrix(X_train, random_state=random_state, workers=workers, features=set(unconfirmed))
+            matrix.loc[unconfirmed] = exact.loc[unconfirmed, matrix.columns].astype(matrix.dtypes.iloc[0])
+            confirmed.update(unconfirmed)
+            continue
+        dropped.append((names[drop], names[partner], best[drop], pairs[drop]))
+
+        # Rows that used the dropped feature are computed again with the cheap estimator
+        confirmed -= set(names[values[:, drop] > 0])
+        X_train = X_train.drop(columns=names[drop])
+        matrix = _drop_features(X_train, matrix, [names[drop]], method, fraction, n_estimators, random_state, workers)
+
+    dropped = pd.DataFrame(dropped, columns=['feature', 'partner', 'dependence', 'pairs'])
+    return X.drop(columns=list(dropped['feature'])), dropped
 
 
 def _get_input_drop(value):
@@ -55,20 +290,39 @@ def _get_input_drop(value):
     return choice
 
 
-def remove_partial_dependencies(X, y, threshold, interactive=True, verbose=False, dropped_list=None):
-    # Get partial dependencies
-    if verbose:
-        print("Building partial dependency table...")
-    df_partial = _get_partial_dependencies(X, y, threshold)    
-    
-    # Base case: No partial dependencies above the threshold
-    if df_partial.empty:
+def remove_partial_dependencies(X, y, threshold, interactive=True, verbose=False, dropped_list=None, workers=None,
+                                strategy='highest', method='exact', confirm=False):
+    # Non-interactive runs drop one feature at a time with prune_dependencies
+    if not interactive:
+        if verbose:
+            print("Building partial dependency table...")
+        X, dropped = prune_dependencies(X, y, threshold, strategy=strategy, workers=workers, method=method, confirm=confirm)
         if verbose:
+            for row in dropped.itertuples():
+                print(f"Dropping: '{row.feature}'{''.ljust(28-len(row.feature))} {row.dependence:.2f} dependence with: \t'{row.partner}'")
             print("Done.")
+        if dropped_list is not None:
+            dropped_list.extend(dropped['feature'])
         return X
-    
-    # Recursive: Drop partial dependencies and run again
-    if interactive:
+
+    # The dependence matrix is built once with the defaults of _get_partial_dependencies, and after each round only the rows
+    # of features that depended on a dropped feature are computed again
+    if verbose:
+        print("Building partial dependency table...")
+    X_train = train_test_split(X, y, test_size=0.2, random_state=1)[0]
+    matrix = _get_dependence_matrix(X_train, method, 0.1, 10, 1, workers)
+    while True:
+        # Get partial dependencies
+        df_partial = _get_pairs(matrix, threshold)
+        if confirm and method != 'exact':
+            df_partial = _confirm_pairs(X_train, df_partial, threshold, 1, workers)
+
+        # No partial dependencies above the threshold
+        if df_partial.empty:
+            if verbose:
+                print("Done.")
+            return X
+
         drop_cols = []
         values = df_partial.values
         if verbose:
@@ -78,41 +332,35 @@ def remove_partial_dependencies(X, y, threshold, interactive=True, verbose=False
             choice = _get_input_drop(value)
             if choice is not None:
                 drop_cols.append(value[choice])
-    else:
-        drop_cols = list(df_partial['index'].values)
-    
-    # Remove duplicate columns from drop_cols
-    drop_cols = list(dict.fromkeys(drop_cols))
-    
-    if verbose:
-        print("Dropping: ", end='')
-        for i, drop_col in enumerate(drop_cols):
-            if i: print(', ', end='')
-            print(drop_col, end='')
-        print()
-    
-    # Check if dropped_list was passed as a parameter (dropped_list will not be default value)
-    # This is necessary because checking if None evaluates True in the case of both the default
-    # argument and in the case of an empty list that was passed as the parameter 'dropped_list'
-    if dropped_list is not remove_partial_dependencies.__defaults__[2]:
-        # Append() will modify the list that was passed as the parameter, not a copy
-        for drop_col in drop_cols:
-            dropped_list.append(drop_col)
-
-    X = X.drop(columns=drop_cols, axis=1)
-
-    if interactive:
+
+        # Remove duplicate columns from drop_cols
+        drop_cols = list(dict.fromkeys(drop_cols))
+
+        if verbose:
+            print("Dropping: ", end='')
+            for i, drop_col in enumerate(drop_cols):
+                if i: print(', ', end='')
+                print(drop_col, end='')
+            print()
+
+        # Extend() modifies the list that was passed as the parameter, not a copy
+        if dropped_list is not None:
+            dropped_list.extend(drop_cols)
+
+        X = X.drop(columns=drop_cols, axis=1)
+        X_train = X_train.drop(columns=drop_cols)
+        if drop_cols:
+            if verbose:
+                print("Updating partial dependency table...")
+            matrix = _drop_features(X_train, matrix, drop_cols, method, 0.1, 10, 1, workers)
+
         choice = -1
         while True:
             choice = input("Continue finding partial dependencies? (y/n): ")
             if choice in ('y', 'n'):
                 break
-        if choice == 'y':
-            return remove_partial_dependencies(X, y, threshold, verbose=verbose, dropped_list=dropped_list)
-        else:
+        if choice == 'n':
             return X
-    else:
-        return remove_partial_dependencies(X, y, threshold, verbose=verbose, dropped_list=dropped_list)
 
 """
 if __name__ == "__main__":        
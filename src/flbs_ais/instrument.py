@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+
+# Recorder that stages are reported to, None when instrumentation is off
+_recorder = None
+_local = threading.local()
+
+
+class Recorder:
+    """Stages recorded while instrumentation is on. Each record is a dictionary with the stage name, wall time in seconds,
+    number of rows and, when memory is tracked, the peak bytes allocated above the start of the stage"""
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def as_dict(self):
+        """Returns totals for each stage in the order stages first ran: calls, seconds, rows and the largest peak bytes"""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'rows': None, 'peak_bytes': None})
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            if record['rows'] is not None:
+                total['rows'] = (total['rows'] or 0) + record['rows']
+            if record['peak_bytes'] is not None:
+                total['peak_bytes'] = max(total['peak_bytes'] or 0, record['peak_bytes'])
+        return totals
+
+    def log(self, logger=None, level=logging.INFO):
+        """Logs the totals of each stage as one JSON message per stage, with the fields also set on the log record"""
+        logger = logger or logging.getLogger('flbs_ais')
+        for name, total in self.as_dict().items():
+            fields = {'stage': name, **total}
+            logger.log(level, json.dumps(fields), extra=fields)
+
+
+@contextmanager
+def record(memory=False):
+    """Records the stages run inside the block and yields the Recorder. With memory=True, peak memory of each stage is
+    measured with tracemalloc, which slows allocations down while the block runs"""
+    global _recorder
+    if _recorder is not None:
+        raise RuntimeError("Instrumentation is already recording - Nested record() blocks are not supported")
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _recorder = Recorder(memory)
+    try:
+        yield _recorder
+    finally:
+        _recorder = None
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+def stage(name):
+    """Returns a context manager timing a stage of work, which yields a dictionary where the number of rows can be set.
+    When instrumentation is off this does nothing beyond returning a shared context manager"""
+    if _recorder is None:
+        return _NULL_STAGE
+    return _stage(_recorder, name)
+
+
+class _NullStage:
+    """Context manager used while instrumentation is off, yielding a dictionary whose contents are ignored"""
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+@contextmanager
+def _stage(recorder, name):
+    """Yields the record of a stage and adds it to recorder when the stage ends"""
+    entry = {'stage': name, 'seconds': None, 'rows': None, 'peak_bytes': None}
+    open_stages = getattr(_local, 'stages', None)
+    if open_stages is None:
+        open_stages = _local.stages = []
+
+    # Peaks are reset for each stage, so stages that are still open keep the peak reached so far
+    track_memory = recorder.memory and tracemalloc.is_tracing()
+    if track_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        for outer in open_stages:
+            outer['peak'] = max(outer['peak'], peak)
+        tracemalloc.reset_peak()
+        entry['start'], entry['peak'] = current, current
+    open_stages.append(entry)
+
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        entry['seconds'] = time.perf_counter() - start
+        open_stages.pop()
+        if track_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            for open_entry in open_stages + [entry]:
+                open_entry['peak'] = max(open_entry['peak'], peak)
+            tracemalloc.reset_peak()
+            entry['peak_bytes'] = entry.pop('peak') - entry.pop('start')
+        recorder.add(entry)
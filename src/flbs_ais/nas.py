@@ -1,117 +1,192 @@
 #!/usr/bin/env python3
 
+import functools
+import hashlib
+import json
 import math
 import requests
+import os
 import os.path
 import sys
+import threading
+import time
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from os import path
 
 import numpy as np
 import pandas as pd
 
+from flbs_ais import cache, catalog, instrument
+from flbs_ais.refs import RefArray
 
-URL_BASE = 'http://nas.er.usgs.gov/api/v1/'
 
+URL_BASE = 'http://nas.er.usgs.gov/api/v1/'
 
-def api_df(species_id, limit, api_key):
-    """Returns a pandas dataframe containing records about a species from the NAS database using their API"""
-    
-    # Check for API key
-    if api_key is not None:
-        url_request = f"{URL_BASE}/occurrence/search?species_ID={species_id}&api_key={api_key}"
-    else:
-        url_request = f"{URL_BASE}/occurrence/search?species_ID={species_id}"
-    
-    # Get dataframe from API request
-    request_json = requests.get(url_request, params={'limit':limit}).json()
-    api_df = pd.json_normalize(request_json, 'results')
-    api_df = _manage_cols(api_df)
-
-    # Add columns that are in a CSV dataframe but not an API dataframe
-    api_df['country']      = np.nan
-    api_df['drainagename'] = np.nan
-
-    # Rename columns
-    renamed_columns = _get_col_rename(api_df, 'api')
-    api_df = api_df.rename(columns=renamed_columns)
-
-    # Reorder columns
-    cols = list(api_df.columns)
-    cols = cols[0:8] + cols[33:34] + cols[8:33] + cols[34:] # country
-    cols = cols[0:16] + cols[34:] + cols[16:34] # drainagename
-    api_df = api_df[cols]
+# Paging and retry defaults for occurrence queries
+PAGE_SIZE   = 1000
+MAX_WORKERS = 4
+MAX_RETRIES = 3
+BACKOFF     = 0.5
+# Seconds to wait for a connection and then for each read of a response before retrying
+TIMEOUT     = (10, 60)
+
+# Status codes worth retrying: rate limiting and transient server errors
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_session = None
+_pool_size = 0
+_session_lock = threading.Lock()
+
+# Schema metadata key holding the state of sync_df in a store file
+_SYNC_METADATA = b'flbs_ais.sync'
+
+# Source of each column from get_header(): its name in a NAS CSV file and in a NAS API record, None when the source
+# doesn't have it. CSV references come from the numbered reference blocks instead of one column
+_COLUMN_SOURCES = {
+    'specimennumber':   ('Specimen Number',    'key'),
+    'speciesid':        ('Species ID',         'speciesID'),
+    'group':            ('Group',              'group'),
+    'family':           ('Family',             'family'),
+    'genus':            (None,                 'genus'),
+    'species':          (None,                 'species'),
+    'scientificname':   ('Scientific Name',    'scientificName'),
+    'commonname':       ('Common Name',        'commonName'),
+    'country':          ('Country',            None),
+    'state':            ('State',              'state'),
+    'county':           ('County',             'county'),
+    'locality':         ('Locality',           'locality'),
+    'latitude':         ('Latitude',           'decimalLatitude'),
+    'longitude':        ('Longitude',          'decimalLongitude'),
+    'source':           ('Source',             'latLongSource'),
+    'accuracy':         ('Accuracy',           'latLongAccuracy'),
+    'drainagename':     ('Drainage Name',      None),
+    'centroidtype':     (None,                 'centroidType'),
+    'huc8name':         (None,                 'huc8Name'),
+    'huc8':             ('HUC 8 Number',       'huc8'),
+    'huc10name':        (None,                 'huc10Name'),
+    'huc10':            (None,                 'huc10'),
+    'huc12name':        (None,                 'huc12Name'),
+    'huc12':            (None,                 'huc12'),
+    'date':             (None,                 'date'),
+    'year':             ('Year',               'year'),
+    'month':            ('Month',              'month'),
+    'day':              ('Day',                'day'),
+    'status':           ('Status',             'status'),
+    'comments':         ('Comments',           'comments'),
+    'recordtype':       ('record_type',        'recordType'),
+    'disposal':         ('disposal',           'disposal'),
+    'museumcatnumber':  ('Museum_Cat_No',      'museumCatNumber'),
+    'freshmarineintro': ('fresh_marine_intro', 'freshMarineIntro'),
+    'references':       (None,                 'references'),
+}
+
+# Number of reference blocks in a NAS CSV file, and the fields of each block
+# mapped to their names in an API reference dictionary
+REF_BLOCKS = 6
+_REF_FIELDS = {'reference': 'key', 'type': 'refType', 'date': 'year', 'author': 'author',
+               'title': 'title', 'publisher': 'publisher', 'location': 'publisherLocation'}
+# Columns holding the reference blocks in a NAS CSV file, under the names they have until they become references
+_CSV_REF_COLUMNS = {f"{field}{i+1}": f"{field.capitalize()} {i+1}" for i in range(REF_BLOCKS) for field in _REF_FIELDS}
+
+
+def api_df(species_id, limit, api_key, page_size=PAGE_SIZE, workers=MAX_WORKERS, float32_coords=False):
+    """Returns a pandas dataframe containing records about a species from the NAS database using their API.
+    Records are requested in pages of page_size, using up to workers concurrent requests. A limit of -1 returns all records.
+    Columns have the types from get_schema(float32_coords)."""
     
+    # Get dataframe from paged API requests, each page is parsed into typed columns as soon as it arrives
+    # so the decoded records of only a few pages are held at once
+    pages = _fetch_pages(species_id, limit, api_key, page_size, workers,
+                         transform=lambda records: _normalize_api(records, float32_coords))
+    if len(pages) == 1:
+        return pages[0]
+    with instrument.stage('concat') as entry:
+        api_df = concat_df(pages).reset_index(drop=True)
+        entry['rows'] = len(api_df)
     return api_df
 
 
-def csv_df(filename):
-    """Returns a pandas dataframe containing records about a species from the NAS database using a downloaded CSV file"""
+def csv_df(filename, chunksize=None, float32_coords=False, keep=None, drop=None):
+    """Returns a pandas dataframe containing records about a species from the NAS database using a downloaded CSV file.
+    If chunksize is given, returns a generator of dataframes with at most chunksize records each instead, so large files
+    can be processed with bounded memory. Joining the chunks with concat_df gives the same dataframe as reading the whole file.
+    keep and drop select columns from get_header() as in modify_df, and columns that aren't needed are never parsed.
+    Columns have the types from get_schema(float32_coords)."""
 
-    # Get dataframe from CSV file
-    csv_df = pd.read_csv(filename, low_memory=False)
-
-    csv_df = _manage_cols(csv_df)
-    
-    # Add columns that are in an API dataframe but not a CSV dataframe
-    csv_df['centroidtype'] = np.nan
-    csv_df['date']         = np.nan
-    csv_df['genus']        = np.nan
-    csv_df['huc10name']    = np.nan
-    csv_df['huc10']        = np.nan
-    csv_df['huc12name']    = np.nan
-    csv_df['huc12']        = np.nan
-    csv_df['huc8name']     = np.nan
-    csv_df['species']      = np.nan
-
-    # Rename columns so both csv and api dataframes have identical headers
-    renamed_columns = _get_col_rename(csv_df, 'csv')
-    csv_df = csv_df.rename(columns=renamed_columns)
-    
-    # Reorder columns
-    cols = list(csv_df.columns)
-    cols = cols[:4] + cols[69:70] + cols[75:76] + cols[4:69] + cols[70:75] # species and genus
-    cols = cols[:17] + cols[69:70] + cols[17:69] + cols[70:] # centroidtype
-    cols = cols[:18] + cols[75:] + cols[18:75] # huc8name
-    cols = cols[:20] + cols[72:] + cols[20:72] # huc10name, huc10, huc12name, huc12
-    cols = cols[:24] + cols[75:] + cols[24:75] # date
-    csv_df = csv_df[cols]
-
-    # Change reference columns to single reference column
-    csv_df = _convert_refs(csv_df)
-    
-    return csv_df
+    # Get dataframe from CSV file, parsing only the needed columns straight into their final types
+    drop_list = _get_drop_list(get_header(), keep, drop)
+    for colname in drop_list:
+        if colname not in get_header():
+            raise ValueError(f"Can't drop column '{colname}' - '{colname}' does not exist in dataframe")
+    columns = [name for name in get_header() if name not in drop_list]
+    options = {'dtype': _csv_dtypes(float32_coords), 'usecols': _csv_source_columns(columns)}
+    if chunksize is not None:
+        reader = pd.read_csv(filename, chunksize=chunksize, **options)
+        return (_normalize_csv(chunk, float32_coords, columns) for chunk in _staged(reader, 'read_csv'))
+    with instrument.stage('read_csv') as entry:
+        csv_df = pd.read_csv(filename, **options)
+        entry['rows'] = len(csv_df)
+    return _normalize_csv(csv_df, float32_coords, columns)
+
+
+def concat_df(dfs):
+    """Returns one dataframe from several occurrence dataframes, keeping the column types from get_schema(). Columns
+    missing from some dataframes are null there. The dataframes and the joined dataframe are all held while joining"""
+    dfs = list(dfs)
+    columns = dfs[0].columns
+    if any(not df.columns.equals(columns) for df in dfs[1:]):
+        columns = functools.reduce(lambda left, right: left.union(right, sort=False), (df.columns for df in dfs))
+        dfs = [df.reindex(columns=columns) for df in dfs]
+
+    # Columns are joined one at a time, categories become the union of every dataframe's categories instead of
+    # falling back to strings as in pd.concat
+    joined = {}
+    for name in columns:
+        arrays = [df[name].array for df in dfs]
+        if all(isinstance(array, pd.Categorical) for array in arrays):
+            joined[name] = pd.api.types.union_categoricals(arrays, sort_categories=True)
+        elif all(array.dtype == arrays[0].dtype for array in arrays):
+            joined[name] = type(arrays[0])._concat_same_type(arrays)
+        else:
+            joined[name] = pd.concat([df[name] for df in dfs]).array
+    index = dfs[0].index.append([df.index for df in dfs[1:]])
+    return pd.DataFrame(joined, index=index)
 
 
-def modify_df(df, keep=None, drop=None, rename=None, refs=None, earth=False):
-    """Returns a dataframe that has altered columns (dropped, renamed), is filtered for a subset of references, and is compatible with Google Earth Engine import"""
+def modify_df(df, keep=None, drop=None, rename=None, refs=None, earth=False, ref_match='first'):
+    """Returns a dataframe that has altered columns (dropped, renamed), is filtered for a subset of references, and is compatible with Google Earth Engine import.
+    ref_match is 'first' to filter on the first reference of each record, or 'any' to keep records with any of the references.
+    With earth, date is a datetime built from year, month and day, and dateprecision tells which of them it used.
+    keep and drop are checked against the columns of df, and dateprecision is kept when keep names it, or without keep,
+    unless date is dropped."""
     
     df_dict = {}
-    drop_list = []
-
-    if drop and keep:
-        if set(list(df.columns)) == set(drop + keep):
-            drop_list = drop
-        else:
-            raise ValueError(f"Drop column list and keep column list do not combine to make set of all columns")
-    elif drop:
-        drop_list = drop
-    elif keep:
-        drop_list = np.setdiff1d(list(df.columns), keep)
 
+    if refs:
+        # Look up matching records in the reference key index, which is kept with the references column
+        if ref_match not in ('first', 'any'):
+            raise ValueError(f"Invalid parameter for ref_match '{ref_match}' - Accepted values are 'first' or 'any'")
+        with instrument.stage('ref_filter') as entry:
+            df = df.iloc[_ref_array(df).key_rows(refs, ref_match)]
+            entry['rows'] = len(df)
+
+    columns = list(df.columns)
     if earth:
         if rename and ( 'latitude' in list(rename.keys()) or 'longitude' in list(rename.keys()) ):
             raise ValueError("Can't rename latitude or longitude when Google Earth Engine import compatibility is true")
         # Create compatible date column
-        df = _make_date_col(df)
-    
-    if refs:
-        df = df[df.astype(str)['references'] != '[]']
-        df['ref_key'] = df.references.map(lambda x: x[0]['key'])
-        df = df[df.ref_key.isin(refs)]
-        df = df.drop('ref_key', axis = 1)
-    
+        with instrument.stage('make_date_col') as entry:
+            df = _make_date_col(df)
+            entry['rows'] = len(df)
+
+    # Keep and drop lists are checked against the columns given, columns added here are kept if keep names them,
+    # or without a keep list, unless date is dropped
+    added = [name for name in df.columns if name not in columns]
+    drop_list = list(_get_drop_list(columns, keep and [name for name in keep if name not in added], drop))
+    drop_list += [name for name in added if (name not in keep if keep else 'date' in drop_list)]
+
     df_out = _manage_cols(df, drop_list, df_dict)
 
     return df_out
@@ -119,26 +194,111 @@ def modify_df(df, keep=None, drop=None, rename=None, refs=None, earth=False):
 
 def csv_out(df, filepath='./', filename=None, overwrite=False):
     """Creates a CSV file using a generated name based on species and references, optionally overwriting or using a custom filename"""
-    
-    if filename == None:
-        # Create generated filename
-        filename = ''
-        if 'commonname' in list(df.columns):
-            filename += (df.iloc[0].commonname).lower().replace(' ','')
-        else:
-            filename += str(datetime.now())
-    else:
-        # TODO: Check if filename is good
-        pass
+    df.to_csv(_get_out_path(df, filepath, filename, overwrite), index=False)
+
+
+def feather_out(df, filepath='./', filename=None, overwrite=False):
+    """Creates an uncompressed Feather (Arrow IPC) file, named like csv_out, that keeps column types and references.
+    Read it back with read_df, which memory-maps the file"""
+    _write_table(df, _get_out_path(df, filepath, filename, overwrite, '.feather'))
+
+
+def parquet_out(df, filepath='./', filename=None, overwrite=False):
+    """Creates a Parquet file, named like csv_out, that keeps column types and references. Read it back with read_df"""
+    _write_table(df, _get_out_path(df, filepath, filename, overwrite, '.parquet'))
+
+
+def read_df(filename, columns=None):
+    """Returns a dataframe from a file created by feather_out or parquet_out, reading only the given columns if any"""
+    return _table_to_df(_read_table(filename, columns))
+
+
+def sync_df(species_id, store, api_key=None, verify=False, page_size=PAGE_SIZE, workers=MAX_WORKERS):
+    """Returns all records about a species from the NAS API, kept in a local Feather or Parquet store file and updated by specimennumber.
+    Only pages from the last synced record onwards are requested, so the cost grows with the number of new records. This relies on
+    the API returning records in a stable order with new records last. With verify=True every page is requested, and only pages
+    whose content changed since the last sync are parsed and upserted. Records deleted from NAS are kept in the store.
+    A store holds one species, syncing another species to it raises a ValueError."""
+
+    # Load the store and the state of the last sync, kept in the file's metadata
+    df, state = None, None
+    if path.exists(store):
+        table = _read_table(store)
+        df = _table_to_df(table)
+        metadata = table.schema.metadata or {}
+        if _SYNC_METADATA in metadata:
+            state = json.loads(metadata[_SYNC_METADATA])
+    if state is not None and state['species_id'] != species_id:
+        raise ValueError(f"Can't sync species '{species_id}' to '{store}' - The store holds species '{state['species_id']}'")
+    if state is None or state['page_size'] != page_size:
+        state = {'species_id': species_id, 'page_size': page_size, 'count': 0, 'page_hashes': []}
+
+    # The number of records synced so far is the high-water mark, the last partial page is requested again
+    first_page = 0 if verify else state['count'] // page_size
+    pages = _fetch_pages(species_id, None, api_key, page_size, workers, first_page * page_size, use_cache=False)
+
+    # Only pages that are new or whose content changed are kept
+    page_hashes = state['page_hashes'][:first_page]
+    changed = []
+    for number, page in enumerate(pages, first_page):
+        page_hash = hashlib.sha1(json.dumps(page, sort_keys=True).encode()).hexdigest()
+        if number >= len(state['page_hashes']) or state['page_hashes'][number] != page_hash:
+            changed += page
+        page_hashes.append(page_hash)
+    count = first_page * page_size + sum(len(page) for page in pages)
+
+    if df is None:
+        df = _normalize_api(changed)
+    elif changed:
+        # Upsert: changed records replace their stored versions, new records are added at the end
+        new_df = _normalize_api(changed)
+        df = concat_df([df[~df['specimennumber'].isin(new_df['specimennumber'])], new_df])
+        df = df.reset_index(drop=True)
+
+    if changed or not path.exists(store) or count != state['count'] or page_hashes != state['page_hashes']:
+        state.update(count=count, page_hashes=page_hashes)
+        _write_table(df, store, {_SYNC_METADATA: json.dumps(state)})
+
+    return df
 
-    if overwrite == False:
-        # Check if filename already exists
-        filenumber = 0
-        while path.exists(filepath + filename + str(filenumber)):
-            filenumber += 1
-        filename += f"_{filenumber}"
-    
-    df.to_csv(filepath + filename, index=False)
+
+def batch_df(sources, api_key=None, limit=-1, workers=MAX_WORKERS, processes=None, float32_coords=False):
+    """Returns a dataframe of records about many species, indexed by speciesid, and a dataframe reporting each source.
+    Sources are species ids, fetched with api_df on up to workers threads, or CSV file paths, parsed with csv_df on up to
+    processes processes. The report has the number of records, the seconds taken and the error, if any, for each source;
+    a failing source is left out of the records instead of stopping the batch. A string of digits that isn't an existing
+    file is taken as a species id."""
+    sources = list(sources)
+    ids = [int(source) if isinstance(source, str) and source.strip().isdigit() and not path.exists(source) else source
+           for source in sources]
+    is_csv = [isinstance(source, (str, os.PathLike)) for source in ids]
+    jobs = [None] * len(sources)
+
+    # Processes are started before any threads, since forking a process with running threads is unsafe
+    process_pool = ProcessPoolExecutor(max_workers=processes) if any(is_csv) else None
+    try:
+        for i, source in enumerate(ids):
+            if is_csv[i]:
+                jobs[i] = process_pool.submit(_batch_job, source, None, None, float32_coords)
+        if not all(is_csv):
+            # Each api_df call requests its pages on MAX_WORKERS threads of its own
+            _get_session(workers * MAX_WORKERS)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for i, source in enumerate(ids):
+                    if not is_csv[i]:
+                        jobs[i] = executor.submit(_batch_job, source, api_key, limit, float32_coords)
+        results = [job.result() for job in jobs]
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+
+    dfs = [frame for frame, seconds, error in results if frame is not None]
+    df = concat_df(dfs) if dfs else _empty_df(float32_coords)
+    df = df.set_index('speciesid')
+    report = pd.DataFrame([(source, len(frame) if frame is not None else 0, seconds, error)
+                           for source, (frame, seconds, error) in zip(sources, results)],
+                          columns=['source', 'records', 'seconds', 'error'])
+    return df, report
 
 
 def get_header():
@@ -151,11 +311,30 @@ def get_header():
     return str_list
 
 
-def species(genus, species, output='list'):
-    """Returns NAS query results for a binomial name. Output is either a string or a list of references"""
-    url_request_species = f"{URL_BASE}/species/search?genus={genus}&species={species}"
-    request_result = requests.get(url_request_species).json()
-    species_list = request_result['results']
+def get_schema(float32_coords=False):
+    """Returns a dictionary of column names from get_header() and their types in occurrence dataframes.
+    Text with few distinct values is categorical, ids, HUC codes and dates are nullable integers"""
+    coord_type = 'float32' if float32_coords else 'float64'
+    schema = {'specimennumber':'Int64','speciesid':'Int32','group':'category','family':'category', \
+              'genus':'category','species':'category','scientificname':'category','commonname':'category', \
+              'country':'category','state':'category','county':'category','locality':'object', \
+              'latitude':coord_type,'longitude':coord_type,'source':'category','accuracy':'category', \
+              'drainagename':'category','centroidtype':'category','huc8name':'category','huc8':'Int64', \
+              'huc10name':'category','huc10':'Int64','huc12name':'category','huc12':'Int64','date':'object', \
+              'year':'Int16','month':'Int8','day':'Int8','status':'category','comments':'object', \
+              'recordtype':'category','disposal':'category','museumcatnumber':'object','freshmarineintro':'category', \
+              'references':'nasrefs'}
+    return schema
+
+
+def species(genus, species, output='list', refresh=False):
+    """Returns NAS query results for a binomial name. Output is either a string or a list of references.
+    Results come from the local species catalog snapshot, ignoring case, which is downloaded on first use or with refresh.
+    A blank genus or species matches any, as in the NAS API"""
+    index = None if refresh else catalog.load()
+    if index is None:
+        index = catalog.save(_get_json(f"{URL_BASE}species/search", {}, use_cache=not refresh)['results'])
+    species_list = index.find(genus=genus or None, species=species or None, ignore_case=True)
 
     if output == 'string':
         species_str = ""
@@ -170,140 +349,447 @@ def species(genus, species, output='list'):
         raise ValueError(f"Invalid parameter for output '{output}' - Accepted values are 'list' or 'string'")
 
 
-
 def references(df, sort='rank', ascending=True, output='list', limit=-1):
     """Returns a list of references for a dataframe. Sorts by alphabet or rank, in ascending or descending order.
-    Output is either in a string or a list of references."""
-    
-    ref_counts = list(df['references'].value_counts().items())\
+    Output is either in a string or a list of references.
+    Rank 1 is the most common list of references, alphabet sorts by the title of each list's first reference, and limit
+    keeps only the first limit lists in that order."""
+    if sort not in ('rank', 'alphabet'):
+        raise ValueError(f"Invalid parameter for sort '{sort}' - Accepted values are 'rank' or 'alphabet'")
+    if output not in ('list', 'string'):
+        raise ValueError(f"Invalid parameter for output '{output}' - Accepted values are 'list' or 'string'")
 
-    if output == 'string':
-        ref_string = ""
-        if sort == 'rank':
-            if ascending:
-                ref_number = 1
-            else:
-                ref_number = len(ref_counts) + 1
-            for ref_pair in ref_counts:
-                if (ascending == True) and (limit != -1) and (ref_number > limit):
-                    break
-                elif (ascending == False) and (limit != -1) and (ref_number < (len(ref_counts) + 1 - limit)):
-                    break
-                ref_string +=  '--------\n'
-                ref_string += f"Most common reference {ref_number}\n"
-                ref_string += '\n'
-                source_number = 1
-                for ref in ref_pair[0]:
-                    ref_string += f"Source number:      {source_number}\n"
-                    ref_string += f"Title:              {ref['title']}\n"
-                    ref_string += f"Author:             {ref['author']}\n"
-                    ref_string += f"Publisher:          {ref['publisher']}\n"
-                    ref_string += f"Publisher Location: {ref['publisherLocation']}\n"
-                    ref_string += f"Year:               {ref['year']}\n"
-                    ref_string += f"Reference Type:     {ref['refType']}\n"
-                    ref_string += f"Reference Key:      {ref['key']}\n"
-                    ref_string += '\n'
-                    source_number += 1
-                ref_string +=     f"Total Occurrences:  {ref_pair[1]}\n"
-                ref_string += '--------\n'
-                ref_string += '\n'
-                if ascending: 
-                    ref_number += 1
-                else:
-                    ref_number -= 1
-        elif sort == 'alphabet':
-            # TODO: alphabetical sorting
-            pass
+    # Rank 1 is the most common list of references, ties in order of first appearance
+    ref_lists, counts, first = _ref_array(df).list_counts()
+    rank_keys = -counts * (len(df) + 1) + first
+    total = len(rank_keys)
+    limit = total if limit == -1 else min(limit, total)
+
+    if sort == 'rank':
+        keys = rank_keys if ascending else -rank_keys
+        # Only the lists within the limit are sorted
+        order = np.argpartition(keys, limit - 1)[:limit] if 0 < limit < total else np.arange(total)[:limit]
+        order = order[np.argsort(keys[order])]
+        ranks = np.arange(1, limit + 1) if ascending else np.arange(total, total - limit, -1)
+    else:
+        ranks = np.empty(total, dtype=np.int64)
+        ranks[np.argsort(rank_keys)] = np.arange(1, total + 1)
+        # Alphabetical by the title of the first reference, lists without references first and ties by rank
+        table = ref_lists.table
+        titles = table['title'].fillna('').astype(str).str.lower().to_numpy(dtype=object)
+        title_ranks = np.empty(len(table), dtype=np.int64)
+        title_ranks[np.argsort(titles, kind='stable')] = np.arange(len(table))
+        first_keys = ref_lists.first_keys()
+        list_titles = np.full(total, -1, dtype=np.int64)
+        has_refs = first_keys >= 0
+        list_titles[has_refs] = title_ranks[np.searchsorted(table['key'].to_numpy(), first_keys[has_refs])]
+        order = np.lexsort((ranks, list_titles))
+        order = (order if ascending else order[::-1])[:limit]
+        ranks = ranks[order]
+
+    if output == 'list':
+        return list(zip(ref_lists[order], counts[order].tolist()))
+    return _ref_report(ref_lists[order], counts[order], ranks)
+
+
+
+def _get_out_path(df, filepath, filename, overwrite, extension=''):
+    """Returns the path for an output file, generating a filename based on species if none is given"""
+    if filename == None:
+        # Create generated filename
+        filename = ''
+        if 'commonname' in list(df.columns):
+            filename += (df.iloc[0].commonname).lower().replace(' ','')
         else:
-            raise ValueError(f"Invalid parameter for sort '{sort}' - Accepted values are 'rank' or 'alphabet'")
-        return ref_string
-    elif output == 'list':
-        return ref_counts
+            filename += str(datetime.now())
     else:
-        raise ValueError(f"Invalid parameter for output '{output}' - Accepted values are 'list' or 'string'")
+        # TODO: Check if filename is good
+        pass
+
+    if overwrite == False:
+        # Check if filename already exists
+        filenumber = 0
+        while path.exists(f"{filepath}{filename}_{filenumber}{extension}"):
+            filenumber += 1
+        filename += f"_{filenumber}"
 
+    return f"{filepath}{filename}{extension}"
 
 
-def _get_col_rename(df, dftype):
-    """Returns a dictionary of columns to rename based on the dataframe and type('csv' or 'api')"""
-    
-    # Build a dictionary of column renamings for use in pandas rename function
-    renamed_columns = {}
-    column_names = list(df.columns)
-    lower_columns = [name.lower().replace(' ','').replace('_','') for name in column_names]
-    for i in range(len(column_names)):
-        renamed_columns[column_names[i]] = lower_columns[i]
-
-    if dftype == 'csv':
-        # build csv rename dictionary
-        renamed_columns['museumcatno'] = 'museumcatnumber'
-        renamed_columns['huc8number']  = 'huc8'
-    elif dftype == 'api':
-        # build api rename dictionary
-        renamed_columns['key']              = 'specimennumber'
-        renamed_columns['decimallatitude']  = 'latitude'
-        renamed_columns['decimallongitude'] = 'longitude'
-        renamed_columns['latlongsource']    = 'source'
-        renamed_columns['latlongaccuracy']  = 'accuracy'
+def _write_table(df, filename, metadata=None):
+    """Writes a dataframe to a Feather file, or a Parquet file if filename ends with .parquet, keeping pandas column types
+    and any extra metadata in the file's schema"""
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df)
+    if metadata:
+        table = table.replace_schema_metadata({**table.schema.metadata, **metadata})
+    if str(filename).endswith('.parquet'):
+        from pyarrow import parquet
+        parquet.write_table(table, filename)
     else:
-        raise ValueError(f"Dataframe type '{dftype}' invalid - Accepted inputs are 'csv' or 'api'")
+        from pyarrow import feather
+        feather.write_feather(table, filename, compression='uncompressed')
 
-    return renamed_columns
 
+def _read_table(filename, columns=None):
+    """Returns a memory-mapped pyarrow table from a file written by _write_table"""
+    if str(filename).endswith('.parquet'):
+        from pyarrow import parquet
+        return parquet.read_table(filename, columns=columns, memory_map=True)
+    from pyarrow import feather
+    return feather.read_table(filename, columns=columns, memory_map=True)
 
-def _convert_refs(df):
-    drop_list = []
 
-    # Always remove the separate reference fields
-    for i in range(6):
-        drop_list.append(f"reference{i+1}")
-        drop_list.append(f"type{i+1}")
-        drop_list.append(f"date{i+1}")
-        drop_list.append(f"author{i+1}")
-        drop_list.append(f"title{i+1}")
-        drop_list.append(f"publisher{i+1}")
-        drop_list.append(f"location{i+1}")
-
-    # Convert separate reference fields into a list of reference dictionaries
-    # This is for compatibility with NAS API dataframes
-    ref_list_of_lists = [None] * len(df)
-    i = 0
-    for row in df.itertuples():
-        ref_list = []
-        for j in range(6):
-            # For each reference section in row, build a dict and add it to the list of dicts
-            ref_dict = {}
-            # Convert key and date to integer instead of float if existent
-            ref_dict['key'] = int(row[35 + j * 7]) if not math.isnan(row[35 + j * 7]) else math.nan
-            if not math.isnan(ref_dict['key']):
-                ref_dict['refType']           = row[36 + j * 7]
-                ref_dict['year']              = int(row[37 + j * 7]) if not math.isnan(row[37 + j * 7]) else math.nan
-                ref_dict['author']            = row[38 + j * 7]
-                ref_dict['title']             = row[39 + j * 7]
-                ref_dict['publisher']         = row[40 + j * 7]
-                ref_dict['publisherLocation'] = row[41 + j * 7]
-                ref_list.append(ref_dict)
-            else:
-                break
-        ref_list_of_lists[i] = ref_list
-        i += 1
-
-    # Add reference column and drop unwanted columns, rename
-    df['references'] = ref_list_of_lists
-    df = df.drop(drop_list, axis=1)
+def _table_to_df(table):
+    """Returns a dataframe from a pyarrow table written by _write_table"""
+    df = table.to_pandas()
 
+    # Parquet drops the type of categorical columns without values, and missing text comes back as None
+    for name, dtype in get_schema().items():
+        if name in df and dtype == 'category':
+            df[name] = df[name].astype(dtype)
+    for name in df.columns[df.dtypes == object]:
+        df[name] = df[name].where(df[name].notna(), np.nan)
     return df
 
 
+def _get_session(pool_size=MAX_WORKERS):
+    """Returns a shared requests session with a connection pool for at least pool_size concurrent requests.
+    The pool is replaced by a larger one when more concurrent requests are asked for than it holds"""
+    global _session, _pool_size
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _pool_size:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _pool_size = pool_size
+    return _session
+
+
+def _get_json(url, params, retries=MAX_RETRIES, backoff=BACKOFF, use_cache=True):
+    """Returns the decoded JSON body of a GET request, retrying transient failures with exponential backoff.
+    Responses are served from and saved to the local cache when it is enabled, unless use_cache is False"""
+    use_cache = use_cache and cache.is_enabled()
+    if use_cache:
+        response_json = cache.get(url, params)
+        if response_json is not None:
+            return response_json
+        if cache.is_offline():
+            raise LookupError(f"No cached response for '{url}' with parameters {params} in offline mode")
+
+    session = _get_session()
+    for attempt in range(retries + 1):
+        try:
+            with instrument.stage('http'):
+                response = session.get(url, params=params, timeout=TIMEOUT)
+            if response.status_code not in _RETRY_STATUS:
+                response.raise_for_status()
+                with instrument.stage('json_decode') as entry:
+                    response_json = response.json()
+                    entry['rows'] = len(response_json.get('results', ())) if isinstance(response_json, dict) else None
+                if use_cache:
+                    cache.put(url, params, response_json)
+                return response_json
+            error = requests.HTTPError(f"{response.status_code} response from {response.url}", response=response)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt)
+    raise error
+
+
+def _fetch_pages(species_id, limit, api_key, page_size=PAGE_SIZE, workers=MAX_WORKERS, start=0, use_cache=True, transform=None):
+    """Returns pages of occurrence records for a species, starting at record number start, as lists of records.
+    If transform is given, each page is returned as transform(records) instead, applied as soon as the page arrives"""
+    if transform is None:
+        transform = list
+    url_request = f"{URL_BASE}occurrence/search"
+    params = {'species_ID': species_id}
+    if api_key is not None:
+        params['api_key'] = api_key
+    if limit is not None and limit < 0:
+        limit = None
+
+    _get_session(workers)
+
+    def get_page(offset, size):
+        return transform(_get_json(url_request, {**params, 'offset': offset, 'limit': size}, use_cache=use_cache)['results'])
+
+    # First page tells us how many records there are in total
+    first_size = page_size if limit is None else min(page_size, limit)
+    first_page = _get_json(url_request, {**params, 'offset': start, 'limit': first_size}, use_cache=use_cache)
+    first_records = first_page['results']
+    total = first_page.get('count')
+    del first_page
+
+    if total is None:
+        # No total count available, so walk the pages one at a time until a short page
+        pages = [transform(first_records)]
+        fetched = len(pages[0])
+        while len(pages[-1]) == page_size and (limit is None or fetched < limit):
+            size = page_size if limit is None else min(page_size, limit - fetched)
+            pages.append(get_page(start + fetched, size))
+            fetched += len(pages[-1])
+        return pages
+
+    end = total if limit is None else min(total, start + limit)
+    offsets = range(start + len(first_records), end, page_size)
+    if not first_records or not offsets:
+        return [transform(first_records[:max(end - start, 0)])]
+    pages = [transform(first_records)]
+    del first_records
+
+    # Remaining pages are fetched concurrently, map keeps them in offset order
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages += executor.map(lambda offset: get_page(offset, min(page_size, end - offset)), offsets)
+
+    return pages
+
+
+def _batch_job(source, api_key, limit, float32_coords):
+    """Returns the dataframe for one batch_df source, the seconds taken and an error message, or None for a failure"""
+    start = time.perf_counter()
+    try:
+        if isinstance(source, (str, os.PathLike)):
+            df = csv_df(source, float32_coords=float32_coords)
+        else:
+            df = api_df(source, limit, api_key, float32_coords=float32_coords)
+        return df, time.perf_counter() - start, None
+    except Exception as error:
+        return None, time.perf_counter() - start, f"{type(error).__name__}: {error}"
+
+
+def _normalize_api(records, float32_coords=False):
+    """Returns a dataframe of occurrence records from the API in the standard column layout"""
+    if not records:
+        return _empty_df(float32_coords)
+
+    # Records are flat, so each field is gathered straight into its column in the standard layout
+    with instrument.stage('columnar') as entry:
+        columns = {name: [record.get(source) for record in records] if source is not None else np.full(len(records), np.nan)
+                   for name, (_, source) in _COLUMN_SOURCES.items()}
+        entry['rows'] = len(records)
+    with instrument.stage('convert_refs') as entry:
+        columns['references'] = RefArray._from_sequence(columns['references'])
+        entry['rows'] = len(records)
+
+    with instrument.stage('schema') as entry:
+        api_df = _apply_schema(pd.DataFrame(columns), float32_coords)
+        entry['rows'] = len(api_df)
+    
+    return api_df
+
+
+def _empty_df(float32_coords=False):
+    """Returns an occurrence dataframe without records"""
+    df = pd.DataFrame({name: np.array([], dtype=object) for name in get_header()})
+    df['references'] = RefArray._from_sequence([])
+    return _apply_schema(df, float32_coords)
+
+
+def _normalize_csv(csv_df, float32_coords=False, columns=None):
+    """Returns a dataframe read from a NAS CSV file in the standard column layout, or only the given columns of it"""
+    if columns is None:
+        columns = get_header()
+
+    # The standard layout is put together from the columns read, without copying them, with the reference fields last
+    # until they become the references column
+    with instrument.stage('columns') as entry:
+        layout = {}
+        for name in columns:
+            source = _COLUMN_SOURCES[name][0]
+            if source is not None:
+                layout[name] = csv_df[source]
+            elif name != 'references':
+                layout[name] = np.full(len(csv_df), np.nan)
+        if 'references' in columns:
+            layout.update((name, csv_df[source]) for name, source in _CSV_REF_COLUMNS.items())
+        csv_df = pd.DataFrame(layout, index=csv_df.index, copy=False)
+        entry['rows'] = len(csv_df)
+
+    # Change reference columns to single reference column
+    if 'references' in columns:
+        with instrument.stage('convert_refs') as entry:
+            csv_df = _convert_refs(csv_df)
+            entry['rows'] = len(csv_df)
+
+    with instrument.stage('schema') as entry:
+        csv_df = _apply_schema(csv_df, float32_coords)
+        entry['rows'] = len(csv_df)
+    
+    return csv_df
+
+
+def _staged(iterable, name):
+    """Yields the items of an iterable, such as the chunks of a CSV reader, timing each step as an instrumentation stage"""
+    iterator = iter(iterable)
+    while True:
+        with instrument.stage(name) as entry:
+            item = next(iterator, None)
+            entry['rows'] = len(item) if item is not None else 0
+        if item is None:
+            return
+        yield item
+
+
+def _csv_source_columns(columns):
+    """Returns the names of the columns in a NAS CSV file needed for the given columns from get_header()"""
+    sources = [_COLUMN_SOURCES[name][0] for name in columns if _COLUMN_SOURCES[name][0] is not None]
+    if 'references' in columns:
+        sources += list(_CSV_REF_COLUMNS.values())
+    return sources
+
+
+def _get_drop_list(columns, keep, drop):
+    """Returns the columns to drop from a dataframe with the given columns, from lists of columns to keep and to drop"""
+    drop_list = []
+    if drop and keep:
+        if set(columns) == set(drop + keep):
+            drop_list = drop
+        else:
+            raise ValueError(f"Drop column list and keep column list do not combine to make set of all columns")
+    elif drop:
+        drop_list = drop
+    elif keep:
+        drop_list = np.setdiff1d(columns, keep)
+    return drop_list
+
+
+def _csv_dtypes(float32_coords=False):
+    """Returns a dictionary of column types for reading a NAS CSV file, using the schema type of each column.
+    Nullable integers are read as floats and converted later, which is much faster than parsing them directly.
+    Reference keys and dates are read as floats, all other reference fields as text"""
+    schema = get_schema(float32_coords)
+    dtypes = {}
+    for name, (source, _) in _COLUMN_SOURCES.items():
+        if source is not None:
+            dtypes[source] = np.float64 if schema[name].startswith('Int') else schema[name]
+    for i in range(REF_BLOCKS):
+        for field in _REF_FIELDS:
+            dtypes[f"{field.capitalize()} {i+1}"] = str
+        dtypes[f"Reference {i+1}"] = np.float64
+        dtypes[f"Date {i+1}"]      = np.float64
+    return dtypes
+
+
+def _apply_schema(df, float32_coords=False):
+    """Returns a dataframe with its columns converted to the types from get_schema(), for the columns it has"""
+    schema = {name: dtype for name, dtype in get_schema(float32_coords).items() if name in df}
+    for name, dtype in schema.items():
+        # Numbers that arrive as text, such as HUC codes from the API, are parsed first
+        if dtype not in ('category', 'object', 'nasrefs') and df[name].dtype == object:
+            df[name] = pd.to_numeric(df[name], errors='coerce')
+        # Empty text columns are all NaN floats, which would give categories of floats
+        elif dtype == 'category' and df[name].dtype == np.float64:
+            df[name] = df[name].astype(object)
+        # Missing text is NaN, as in a CSV file, even when the API sent null
+        elif dtype == 'object':
+            df[name] = df[name].where(df[name].notna(), np.nan)
+    return df.astype(schema, copy=False)
+
+
+def _convert_refs(df):
+    """Replaces the numbered reference fields of a CSV dataframe with a single references column"""
+
+    # Convert separate reference fields into one references column
+    # This is for compatibility with NAS API dataframes
+    # Each field is read as a (row x block) matrix, so all six blocks are handled at once
+    def block_matrix(field, dtype=object):
+        return df[[f"{field}{i+1}" for i in range(REF_BLOCKS)]].to_numpy(dtype=dtype)
+
+    keys = block_matrix('reference', float)
+
+    # A reference only counts if every block before it has a key as well
+    valid = np.logical_and.accumulate(~np.isnan(keys), axis=1)
+
+    # Selecting with the mask flattens row by row, keeping each row's references in block order
+    rows = np.nonzero(valid)[0]
+    fields = {name: block_matrix(field)[valid] for field, name in _REF_FIELDS.items() if name != 'key'}
+    fields['key'] = keys[valid].astype(np.int64)
+
+    # The reference fields are left out and the other columns are kept without copying them
+    columns = {name: df[name] for name in df if name not in _CSV_REF_COLUMNS}
+    columns['references'] = RefArray.from_blocks(rows, fields, len(df))
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def _ref_array(df):
+    """Returns the references column of a dataframe as a RefArray, converting a column of lists if needed"""
+    refs = df['references'].array
+    if not isinstance(refs, RefArray):
+        refs = RefArray._from_sequence(df['references'])
+    return refs
+
+
+def _ref_report(ref_lists, counts, ranks):
+    """Returns the text report of references(), with the text of each reference built once and everything joined at the end"""
+    rows, positions = ref_lists.ref_positions()
+    table = ref_lists.table
+    used = np.unique(positions)
+    years = [int(year) if year == year else math.nan for year in table['year'].to_numpy()[used]]
+    columns = [table[name].to_numpy(dtype=object)[used] for name in ('title', 'author', 'publisher', 'publisherLocation')]
+    columns += [years, table['refType'].to_numpy(dtype=object)[used], table['key'].to_numpy()[used]]
+    blocks = dict(zip(used.tolist(), (f"Title:              {title}\n"
+                                      f"Author:             {author}\n"
+                                      f"Publisher:          {publisher}\n"
+                                      f"Publisher Location: {location}\n"
+                                      f"Year:               {year}\n"
+                                      f"Reference Type:     {ref_type}\n"
+                                      f"Reference Key:      {key}\n\n"
+                                      for title, author, publisher, location, year, ref_type, key in zip(*columns))))
+
+    # References of each list are consecutive, ends are where the next list starts
+    ends = np.searchsorted(rows, np.arange(1, len(ref_lists) + 1)).tolist()
+    positions = positions.tolist()
+    parts = []
+    start = 0
+    for end, count, rank in zip(ends, counts.tolist(), ranks.tolist()):
+        parts.append(f"--------\nMost common reference {rank}\n\n")
+        for source_number, position in enumerate(positions[start:end], 1):
+            parts.append(f"Source number:      {source_number}\n")
+            parts.append(blocks[position])
+        parts.append(f"Total Occurrences:  {count}\n--------\n\n")
+        start = end
+    return ''.join(parts)
+
+
 def _make_date_col(df):
-    df = df.fillna(1)
-    df['date'] = pd.to_datetime(df.year*10000 + df.month*100 + df.day, format='%Y%m%d')
-    return df 
+    """Returns a shallow copy of df with a datetime date column built from year, month and day, and a dateprecision column
+    of 'day', 'month' or 'year' for the parts used. Unknown or invalid months and days count as the first of the year or
+    month, and records without a year, or with a year outside the range of datetime64[ns], get NaT"""
+    year, month, day = (df[part].to_numpy(dtype=np.float64, na_value=np.nan) for part in ('year', 'month', 'day'))
+
+    # Each part is only used when the parts above it are, and when it is a valid value
+    has_year = ~np.isnan(year) & (year > pd.Timestamp.min.year) & (year < pd.Timestamp.max.year)
+    has_month = has_year & (month >= 1) & (month <= 12)
+    months = np.where(has_year, year - 1970, 0).astype('datetime64[Y]').astype('datetime64[M]')
+    months = months + np.where(has_month, month - 1, 0).astype('timedelta64[M]')
+    month_days = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+    has_day = has_month & (day >= 1) & (day <= month_days)
+    dates = months.astype('datetime64[D]') + np.where(has_day, day - 1, 0).astype('timedelta64[D]')
+    dates = np.where(has_year, dates, np.datetime64('NaT'))
+
+    codes = np.select([has_day, has_month, has_year], [0, 1, 2], default=-1).astype(np.int8)
+    precision = pd.Categorical.from_codes(codes, categories=['day', 'month', 'year'])
+
+    df = df.copy(deep=False)
+    df['date'] = pd.Series(dates.astype('datetime64[ns]'), index=df.index)
+    if 'dateprecision' in df:
+        df['dateprecision'] = precision
+    else:
+        df.insert(df.columns.get_loc('date') + 1, 'dateprecision', precision)
+    return df
 
 
-def _manage_cols(df, drop_list=[], name_dict={}):
+def _manage_cols(df, drop_list=[], name_dict=None):
     """Private method for dropping and renaming columns in a dataframe, as well as creating one standard table from two different forms."""
 
+    # Fill in a fresh dictionary, a shared default would keep names from earlier calls
+    if name_dict is None:
+        name_dict = {}
+
     for colname in drop_list:
         if colname not in df:
             raise ValueError(f"Can't drop column '{colname}' - '{colname}' does not exist in dataframe")
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+import math
+import numbers
+
+import numpy as np
+import pandas as pd
+
+from pandas.api.extensions import ExtensionArray, ExtensionDtype, register_extension_dtype, take
+from pandas.api.types import pandas_dtype
+
+
+# Fields of a reference dictionary, in the order the NAS API returns them
+REF_FIELDS = ['key', 'refType', 'year', 'author', 'title', 'publisher', 'publisherLocation']
+
+
+@register_extension_dtype
+class RefDtype(ExtensionDtype):
+    """Pandas dtype for a column holding the list of references of each occurrence record"""
+    name = 'nasrefs'
+    type = list
+    kind = 'O'
+    na_value = np.nan
+
+    @classmethod
+    def construct_array_type(cls):
+        return RefArray
+
+    def __from_arrow__(self, array):
+        """Returns a RefArray from a pyarrow list of reference structs, used when reading Parquet and Feather files"""
+        import pyarrow as pa
+
+        # One array for all record batches, so the reference table is built once
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks() if array.num_chunks else pa.array([], type=array.type)
+        offsets = array.offsets.to_numpy()
+        values = array.values.slice(offsets[0], offsets[-1] - offsets[0])
+        rows = np.repeat(np.arange(len(array)), np.diff(offsets))
+        fields = {name: values.field(name).to_numpy(zero_copy_only=False) for name in REF_FIELDS}
+        ref_array = RefArray.from_blocks(rows, fields, len(array))
+        ref_array._codes[array.is_null().to_numpy(zero_copy_only=False)] = -1
+        return ref_array
+
+
+class RefArray(ExtensionArray):
+    """Compact storage for the references of occurrence records.
+
+    Each distinct reference is stored once, in a table with one row per reference key. Each distinct list
+    of references is stored once as well, CSR-style: links holds reference table rows and list i is
+    links[offsets[i]:offsets[i+1]]. Occurrence records only hold an integer code into those lists, -1 if missing.
+    The list of dictionaries for a record is rebuilt on demand."""
+
+    def __init__(self, codes, table, offsets, links):
+        self._codes = np.asarray(codes, dtype=np.int32)
+        self._table = table
+        self._offsets = offsets
+        self._links = links
+        self._dicts = None
+        self._key_index = {}
+
+    @classmethod
+    def from_blocks(cls, rows, fields, length):
+        """Returns an array built from one entry per reference. rows is the record each reference belongs to,
+        in record order and then in reference order, and fields maps each name in REF_FIELDS to an array of values."""
+        rows = np.asarray(rows, dtype=np.int64)
+        keys = np.asarray(fields['key'], dtype=np.int64)
+
+        # Reference table: the first appearance of each key, sorted by key
+        key_codes, unique_keys = pd.factorize(keys)
+        order = np.argsort(unique_keys)
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
+        positions = ranks[key_codes]
+        first = _first_indices(key_codes, len(unique_keys))[order]
+        unique_keys = unique_keys[order]
+        table = pd.DataFrame({name: np.asarray(fields[name])[first] for name in REF_FIELDS})
+        table['key'] = unique_keys
+        table['year'] = pd.to_numeric(table['year'], errors='coerce').astype(np.float64)
+        # Missing text is NaN, as in a CSV file, whether it came in as NaN or None
+        for name in REF_FIELDS[1:]:
+            if table[name].dtype == object:
+                table[name] = table[name].where(table[name].notna(), np.nan)
+
+        # Lay out each record's reference positions in one padded row, then find the distinct rows
+        counts = np.bincount(rows, minlength=length)
+        width = max(int(counts.max()) if length else 0, 1)
+        starts = np.concatenate(([0], np.cumsum(counts)))
+        slots = np.arange(len(rows)) - starts[rows]
+        padded = np.zeros((length, width), dtype=np.int32)
+        padded[rows, slots] = positions + 1
+
+        # Pack each padded row into one integer when it fits, so distinct rows are found by hashing instead of sorting
+        bits = int(len(table)).bit_length()
+        if width * bits <= 63:
+            packed = np.zeros(length, dtype=np.int64)
+            for slot in range(width):
+                packed = (packed << bits) | padded[:, slot]
+            codes, unique_packed = pd.factorize(packed)
+            lists = padded[_first_indices(codes, len(unique_packed))]
+        else:
+            lists, codes = np.unique(padded, axis=0, return_inverse=True)
+
+        # Padding is at the end of each row, so flattening the nonzero entries keeps reference order
+        lengths = (lists > 0).sum(axis=1)
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        links = (lists[lists > 0] - 1).astype(np.int32)
+
+        return cls(codes.reshape(-1), table, offsets, links)
+
+    @classmethod
+    def _from_sequence(cls, scalars, *, dtype=None, copy=False):
+        if isinstance(scalars, cls):
+            return scalars.copy() if copy else scalars
+
+        # Flatten the lists of dictionaries into one entry per reference
+        rows = []
+        fields = {name: [] for name in REF_FIELDS}
+        missing = []
+        for i, ref_list in enumerate(scalars):
+            if not isinstance(ref_list, (list, tuple)):
+                missing.append(i)
+                continue
+            for ref in ref_list:
+                rows.append(i)
+                for name in REF_FIELDS:
+                    fields[name].append(ref.get(name, math.nan))
+        for name in REF_FIELDS:
+            fields[name] = np.array(fields[name], dtype=np.int64 if name == 'key' else object)
+
+        array = cls.from_blocks(rows, fields, len(scalars))
+        array._codes[missing] = -1
+        return array
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        return cls(values, original._table, original._offsets, original._links)
+
+    @property
+    def dtype(self):
+        return RefDtype()
+
+    @property
+    def nbytes(self):
+        return (self._codes.nbytes + self._offsets.nbytes + self._links.nbytes
+                + int(self._table.memory_usage(index=False, deep=True).sum()))
+
+    @property
+    def table(self):
+        """Reference table with one row per reference key"""
+        return self._table
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, item):
+        if isinstance(item, numbers.Integral):
+            code = self._codes[item]
+            return self._ref_list(code) if code >= 0 else self.dtype.na_value
+        item = pd.api.indexers.check_array_indexer(self, item)
+        return self._with_codes(self._codes[item])
+
+    def __setitem__(self, key, value):
+        if isinstance(value, dict):
+            # Pandas unpacks a list holding one reference when setting a single element
+            value = [value]
+        if not isinstance(value, RefArray):
+            value = RefArray._from_sequence([value] if _is_ref_list(value) else list(value))
+        if not isinstance(key, numbers.Integral):
+            key = pd.api.indexers.check_array_indexer(self, key)
+        merged = RefArray._concat_same_type([self, value])
+        codes, new_codes = merged._codes[:len(self)].copy(), merged._codes[len(self):]
+        codes[key] = new_codes[0] if len(new_codes) == 1 else new_codes
+        self._codes = codes
+        self._table, self._offsets, self._links = merged._table, merged._offsets, merged._links
+        self._dicts = None
+        self._key_index = {}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, RefArray) and other._table is self._table:
+            return (self._codes == other._codes) & (self._codes >= 0)
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+        if _is_ref_list(other):
+            other = [other] * len(self)
+        return np.array([repr(a) == repr(b) for a, b in zip(self, other)], dtype=bool)
+
+    def __arrow_array__(self, type=None):
+        """Returns the references as a pyarrow list of reference structs, used when writing Parquet and Feather files"""
+        import pyarrow as pa
+
+        struct_type = pa.struct([('key', pa.int64()), ('refType', pa.string()), ('year', pa.float64()), ('author', pa.string()),
+                                 ('title', pa.string()), ('publisher', pa.string()), ('publisherLocation', pa.string())])
+        table = pa.StructArray.from_arrays(
+            [pa.array(self._table[field.name], type=field.type, from_pandas=True) for field in struct_type],
+            fields=list(struct_type))
+        rows, positions = self.ref_positions()
+        counts = np.bincount(rows, minlength=len(self))
+        offsets = pa.array(np.concatenate(([0], np.cumsum(counts))).astype(np.int32))
+        return pa.ListArray.from_arrays(offsets, table.take(pa.array(positions)), mask=pa.array(self.isna()))
+
+    def __array__(self, dtype=None, copy=None):
+        values = np.empty(len(self), dtype=object)
+        for i, ref_list in enumerate(self):
+            values[i] = ref_list
+        if dtype is not None and np.dtype(dtype).kind == 'U':
+            # Lists are converted one by one, not treated as nested sequences
+            return np.array([str(value) for value in values], dtype=dtype)
+        return values if dtype is None else values.astype(dtype)
+
+    def astype(self, dtype, copy=True):
+        dtype = pandas_dtype(dtype)
+        if isinstance(dtype, RefDtype):
+            return self.copy() if copy else self
+        if dtype == object or dtype.kind == 'U':
+            return self.__array__(dtype)
+        return super().astype(dtype, copy=copy)
+
+    def isna(self):
+        return self._codes < 0
+
+    def take(self, indices, *, allow_fill=False, fill_value=None):
+        codes = take(self._codes, indices, allow_fill=allow_fill, fill_value=-1)
+        return self._with_codes(codes)
+
+    def copy(self):
+        array = self._with_codes(self._codes.copy())
+        # Same records in the same order, so the key index still applies
+        array._key_index = self._key_index
+        return array
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        to_concat = list(to_concat)
+        if all(array._table is to_concat[0]._table for array in to_concat):
+            return to_concat[0]._with_codes(np.concatenate([array._codes for array in to_concat]))
+
+        # Different reference tables, so rebuild from one entry per reference
+        rows, fields, start = [], {name: [] for name in REF_FIELDS}, 0
+        for array in to_concat:
+            array_rows, positions = array.ref_positions()
+            rows.append(array_rows + start)
+            for name in REF_FIELDS:
+                fields[name].append(array._table[name].to_numpy(dtype=object)[positions])
+            start += len(array)
+        fields = {name: np.concatenate(values) if values else np.array([], dtype=object) for name, values in fields.items()}
+        array = cls.from_blocks(np.concatenate(rows), fields, start)
+        array._codes[np.concatenate([a.isna() for a in to_concat])] = -1
+        return array
+
+    def _values_for_factorize(self):
+        return self._codes, -1
+
+    def _values_for_argsort(self):
+        return self._codes
+
+    def value_counts(self, dropna=True):
+        """Returns the number of records with each distinct list of references, most common first"""
+        codes = self._codes[self._codes >= 0] if dropna else self._codes
+        unique, first, counts = np.unique(codes, return_index=True, return_counts=True)
+        # Most common first, ties in order of first appearance
+        order = np.lexsort((first, -counts))
+        index = pd.Index(self._with_codes(unique[order]))
+        return pd.Series(counts[order], index=index, name='count')
+
+    def list_counts(self):
+        """Returns the distinct lists of references as a RefArray with one entry per list, the number of records with
+        each list and the position of the first record with it. Lists are in the order of their codes"""
+        positions = np.flatnonzero(self._codes >= 0)
+        codes = self._codes[positions]
+        counts = np.bincount(codes, minlength=len(self._offsets) - 1)
+        first = np.empty(len(counts), dtype=np.int64)
+        first[codes[::-1]] = positions[::-1]
+        present = np.flatnonzero(counts)
+        return self._with_codes(present.astype(np.int32)), counts[present], first[present]
+
+    def ref_positions(self):
+        """Returns two arrays with one entry per reference of each record: the record, and the reference table row"""
+        valid = self._codes >= 0
+        lengths = np.diff(self._offsets)
+        counts = np.where(valid, lengths[np.maximum(self._codes, 0)], 0)
+        rows = np.repeat(np.arange(len(self)), counts)
+        starts = np.repeat(self._offsets[np.maximum(self._codes, 0)], counts)
+        within = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return rows, self._links[starts + within]
+
+    def first_keys(self):
+        """Returns the key of the first reference of each record, -1 for records without references"""
+        lengths = np.diff(self._offsets)
+        first_keys = np.full(len(lengths), -1, dtype=np.int64)
+        nonempty = lengths > 0
+        first_keys[nonempty] = self._table['key'].to_numpy()[self._links[self._offsets[:-1][nonempty]]]
+        return np.where(self._codes >= 0, first_keys[np.maximum(self._codes, 0)], -1)
+
+    def key_rows(self, keys, match='any'):
+        """Returns the sorted positions of records that have one of the reference keys.
+        match is 'any' to check every reference of a record, or 'first' to check only its first reference.
+        The key index is built on first use and kept with the array, so later lookups only touch matching records."""
+        if match not in ('any', 'first'):
+            raise ValueError(f"Invalid parameter for match '{match}' - Accepted values are 'any' or 'first'")
+        if match not in self._key_index:
+            self._key_index[match] = self._build_key_index(match)
+        index_offsets, index_rows = self._key_index[match]
+
+        # Reference table keys are sorted, so each key is found with a binary search
+        table_keys = self._table['key'].to_numpy()
+        keys = np.unique(np.asarray(keys, dtype=np.int64))
+        positions = np.searchsorted(table_keys, keys)
+        positions = positions[positions < len(table_keys)]
+        positions = positions[np.isin(table_keys[positions], keys)]
+
+        matches = [index_rows[index_offsets[p]:index_offsets[p + 1]] for p in positions]
+        if not matches:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(matches))
+
+    def _build_key_index(self, match):
+        """Returns CSR-style arrays mapping each reference table row to the records that have it"""
+        rows, positions = self.ref_positions()
+        if match == 'first':
+            # Records are in order, so a record's first reference is where the record number changes
+            first = np.concatenate(([True], rows[1:] != rows[:-1])) if len(rows) else np.array([], dtype=bool)
+            rows, positions = rows[first], positions[first]
+        order = np.argsort(positions, kind='stable')
+        index_offsets = np.concatenate(([0], np.cumsum(np.bincount(positions, minlength=len(self._table)))))
+        return index_offsets, rows[order]
+
+    def _with_codes(self, codes):
+        array = RefArray(codes, self._table, self._offsets, self._links)
+        array._dicts = self._dicts
+        return array
+
+    def _ref_list(self, code):
+        """Returns a new list of reference dictionaries for one code"""
+        if self._dicts is None:
+            columns = [self._table[name].tolist() for name in REF_FIELDS]
+            # Keys and known years are whole numbers
+            columns[REF_FIELDS.index('year')] = [int(year) if year == year else math.nan for year in columns[REF_FIELDS.index('year')]]
+            self._dicts = [dict(zip(REF_FIELDS, values)) for values in zip(*columns)]
+        return [dict(self._dicts[j]) for j in self._links[self._offsets[code]:self._offsets[code + 1]]]
+
+
+def _first_indices(codes, count):
+    """Returns the position where each of count factorized codes first appears"""
+    first = np.empty(count, dtype=np.int64)
+    # Writing in reverse leaves the earliest position for each code
+    first[codes[::-1]] = np.arange(len(codes) - 1, -1, -1)
+    return first
+
+
+def _is_ref_list(value):
+    return isinstance(value, list) and all(isinstance(ref, dict) for ref in value)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import math
+
+import numpy as np
+
+from flbs_ais import nas
+
+
+EARTH_RADIUS_KM = 6371.0088
+DEFAULT_CELL_SIZE = 0.25
+
+
+class SpatialIndex:
+    """Grid index over the latitude and longitude of an occurrence dataframe from csv_df or api_df. Records are bucketed
+    into cells of cell_size degrees, kept sorted by cell, so a query only looks at the records of the cells it covers.
+    Records without coordinates are kept in the dataframe but never returned by a query"""
+
+    def __init__(self, df, cell_size=DEFAULT_CELL_SIZE):
+        if not 0 < cell_size <= 90:
+            raise ValueError(f"Invalid parameter for cell_size '{cell_size}' - Accepted values are between 0 and 90")
+        self.cell_size = cell_size
+        self._rows = math.ceil(180 / cell_size)
+        self._cols = math.ceil(360 / cell_size)
+        self._df = df.iloc[:0]
+        self._lat = np.empty(0)
+        self._lon = np.empty(0)
+        self._keys = np.empty(0, dtype=np.int64)
+        self._order = np.empty(0, dtype=np.int64)
+        self.add(df)
+
+    @property
+    def df(self):
+        """Returns the dataframe of every record added to the index"""
+        return self._df
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, df):
+        """Adds the records of df to the index and to its dataframe, without rebuilding the cells already indexed"""
+        if not len(df):
+            return
+        start = len(self._df)
+        self._df = nas.concat_df([self._df, df]) if start else df
+        lat = df['latitude'].to_numpy(dtype=np.float64, na_value=np.nan)
+        lon = df['longitude'].to_numpy(dtype=np.float64, na_value=np.nan)
+        self._lat = np.concatenate([self._lat, lat])
+        self._lon = np.concatenate([self._lon, lon])
+
+        # New records are merged into the sorted cells, only records with coordinates are indexed
+        positions = np.flatnonzero(~np.isnan(lat) & ~np.isnan(lon))
+        keys = self._cell_keys(lat[positions], lon[positions])
+        sort = np.argsort(keys, kind='stable')
+        keys, positions = keys[sort], positions[sort] + start
+        at = np.searchsorted(self._keys, keys, side='right')
+        self._keys = np.insert(self._keys, at, keys)
+        self._order = np.insert(self._order, at, positions)
+
+    def bbox(self, south, west, north, east):
+        """Returns the records inside a bounding box in degrees, in the order they were added. A box with west greater
+        than east crosses the antimeridian"""
+        return self._df.iloc[self._bbox_positions(south, west, north, east)]
+
+    def radius(self, latitude, longitude, km):
+        """Returns the records within km kilometres of a point, nearest first, with their great-circle distance in a
+        distance column"""
+        positions, distances = self._radius_positions(latitude, longitude, km)
+        order = np.argsort(distances, kind='stable')
+        return self._with_distance(positions[order], distances[order])
+
+    def nearest(self, latitude, longitude, k=1):
+        """Returns the k records nearest to a point, nearest first, with their great-circle distance in a distance column"""
+        if k < 1:
+            raise ValueError(f"Invalid parameter for k '{k}' - Accepted values are integers of 1 or more")
+        # The search radius grows until it holds k records, those are then the k nearest
+        km = self.cell_size * math.pi / 180 * EARTH_RADIUS_KM
+        while True:
+            positions, distances = self._radius_positions(latitude, longitude, km)
+            if len(positions) >= k or km >= math.pi * EARTH_RADIUS_KM:
+                break
+            km *= 4
+        order = np.argsort(distances, kind='stable')[:k]
+        return self._with_distance(positions[order], distances[order])
+
+    def _with_distance(self, positions, distances):
+        df = self._df.iloc[positions].copy(deep=False)
+        df['distance'] = distances
+        return df
+
+    def _cell_keys(self, lat, lon):
+        return self._cell_rows(lat) * self._cols + self._cell_cols(lon)
+
+    def _cell_rows(self, lat):
+        return np.clip(((np.asarray(lat) + 90) // self.cell_size).astype(np.int64), 0, self._rows - 1)
+
+    def _cell_cols(self, lon):
+        return np.clip(((np.asarray(lon) + 180) // self.cell_size).astype(np.int64), 0, self._cols - 1)
+
+    def _bbox_positions(self, south, west, north, east):
+        if not -90 <= south <= north <= 90:
+            raise ValueError(f"Invalid bounding box latitudes '{south}', '{north}' - Accepted values are "
+                             f"-90 <= south <= north <= 90")
+        if west > east:
+            positions = np.concatenate([self._bbox_positions(south, west, north, 180),
+                                        self._bbox_positions(south, -180, north, east)])
+            return np.unique(positions)
+
+        # Each row of cells covered by the box is one contiguous range of the sorted keys
+        first_row, last_row = self._cell_rows([south, north])
+        first_col, last_col = self._cell_cols([west, east])
+        rows = np.arange(first_row, last_row + 1) * self._cols
+        starts = np.searchsorted(self._keys, rows + first_col)
+        ends = np.searchsorted(self._keys, rows + last_col + 1)
+        candidates = np.concatenate([self._order[start:end] for start, end in zip(starts, ends)])
+
+        lat, lon = self._lat[candidates], self._lon[candidates]
+        inside = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+        return np.sort(candidates[inside])
+
+    def _radius_positions(self, latitude, longitude, km):
+        """Returns the positions of the records within km kilometres of a point and their distances"""
+        angle = km / EARTH_RADIUS_KM
+        south, north = latitude - math.degrees(angle), latitude + math.degrees(angle)
+        # Widest longitude reached by the circle, which is at a latitude nearer the pole than its centre
+        ratio = math.sin(angle) / math.cos(math.radians(latitude)) if -90 < south and north < 90 else 1
+        if ratio >= 1:
+            candidates = self._bbox_positions(max(south, -90), -180, min(north, 90), 180)
+        else:
+            span = math.degrees(math.asin(ratio))
+            west, east = (longitude - span + 180) % 360 - 180, (longitude + span + 180) % 360 - 180
+            candidates = self._bbox_positions(south, west, north, east)
+
+        distances = _haversine(latitude, longitude, self._lat[candidates], self._lon[candidates])
+        within = distances <= km
+        return candidates[within], distances[within]
+
+
+def _haversine(latitude, longitude, lat, lon):
+    """Returns the great-circle distances in kilometres from a point to arrays of latitudes and longitudes in degrees"""
+    lat1, lon1 = math.radians(latitude), math.radians(longitude)
+    lat2, lon2 = np.radians(lat), np.radians(lon)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks of the nas, clean_csv and feature_importance hot paths on synthetic data at several scales.
+
+    Benchmarks are skipped by the normal test run. Results depend on the machine, so they are kept locally under
+    .benchmarks/, which git ignores. Save a baseline on the commit to compare against with:
+
+        pytest tests/benchmarks --no-cov --benchmark-autosave
+
+    then run the benchmarks on a change and compare with the last saved run with:
+
+        pytest tests/benchmarks --no-cov --benchmark-autosave --benchmark-compare --benchmark-compare-fail=mean:25%
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import make_api_record, make_ee_export, make_nas_csv
+from flbs_ais import clean_csv, feature_importance, nas
+from flbs_ais.spatial import SpatialIndex
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+pytest.importorskip('pytest_benchmark')
+
+# Number of records in the synthetic files and API responses
+SCALES = [1000, 50000]
+
+
+@pytest.fixture(scope='module', params=SCALES, ids=lambda rows: f"{rows}rows")
+def nas_csv(request, tmp_path_factory):
+    return make_nas_csv(tmp_path_factory.mktemp('nas') / 'nas.csv', request.param)
+
+
+@pytest.fixture(scope='module')
+def nas_frame(nas_csv):
+    return nas.csv_df(nas_csv)
+
+
+def test_csv_df(benchmark, nas_csv):
+    df = benchmark(nas.csv_df, nas_csv)
+    assert list(df.columns) == nas.get_header()
+
+
+def test_csv_df_keep(benchmark, nas_csv):
+    df = benchmark(nas.csv_df, nas_csv, keep=['specimennumber', 'latitude', 'longitude', 'year'])
+    assert len(df.columns) == 4
+
+
+def test_convert_refs(benchmark, nas_csv):
+    # The frame just before _convert_refs, in the standard layout with the reference fields last
+    frames = []
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(nas, '_convert_refs', lambda df: frames.append(df) or df)
+        monkeypatch.setattr(nas, '_apply_schema', lambda df, float32_coords=False: df)
+        nas.csv_df(nas_csv)
+    df = benchmark(lambda: nas._convert_refs(frames[0].copy()))
+    assert df.columns[-1] == 'references'
+
+
+@pytest.mark.parametrize('rows', SCALES, ids=lambda rows: f"{rows}rows")
+def test_api_df(benchmark, nas_stub, rows):
+    nas_stub.records = [make_api_record(i) for i in range(rows)]
+    df = benchmark(nas.api_df, 914, -1, None)
+    assert len(df) == rows
+
+
+def test_modify_df(benchmark, nas_frame):
+    refs = list(nas_frame['references'].array.first_keys()[:10])
+    df = benchmark(nas.modify_df, nas_frame, keep=['specimennumber', 'year', 'month', 'day', 'date'], refs=refs, earth=True)
+    assert len(df)
+
+
+def test_references(benchmark, nas_frame):
+    refs = benchmark(nas.references, nas_frame)
+    assert len(refs)
+
+
+def test_spatial_index(benchmark, nas_frame):
+    index = SpatialIndex(nas_frame)
+    latitude, longitude = nas_frame['latitude'].median(), nas_frame['longitude'].median()
+    df = benchmark(index.radius, latitude, longitude, 25)
+    assert df['distance'].max() <= 25
+
+
+@pytest.mark.parametrize('rows', SCALES, ids=lambda rows: f"{rows}rows")
+def test_clean_csv(benchmark, tmp_path, rows):
+    filename = str(tmp_path / 'export.csv')
+    make_ee_export(filename, rows)
+    dfs = benchmark(clean_csv.clean_csv, filename, drop_columns=['.geo'], split_columns=['Elevation', 'Slope'])
+    assert len(dfs) == 2
+
+
+@pytest.mark.parametrize('method', ['exact', 'linear'])
+def test_get_partial_dependencies(benchmark, method):
+    rng = np.random.RandomState(0)
+    X = pd.DataFrame(rng.normal(size=(1000, 8)), columns=[f"band{i}" for i in range(8)])
+    X['band8'] = X['band0'] + rng.normal(scale=0.1, size=1000)
+    y = pd.Series(rng.normal(size=1000))
+
+    # Dependence rows are cached, so every round starts from an empty cache
+    pairs = benchmark.pedantic(feature_importance._get_partial_dependencies, args=(X, y, 0.5), kwargs={'method': method},
+                               setup=feature_importance._dependence_cache.clear, rounds=3)
+    assert len(pairs) == 1
@@ -1,10 +1,186 @@
 # -*- coding: utf-8 -*-
 """
-    Dummy conftest.py for flbs_ais.
+    conftest.py for flbs_ais.
 
-    If you don't know what this is for, just leave it empty.
+    Provides a local stub of the NAS API so that occurrence queries can be
+    tested and benchmarked offline.
     Read more about conftest.py under:
     https://pytest.org/latest/plugins.html
 """
 
-# import pytest
+import json
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from flbs_ais import catalog, nas
+
+
+DEMO_CSV = os.path.join(os.path.dirname(__file__), '..', 'demo', 'NAS_data_914.csv')
+
+
+def pytest_ignore_collect(collection_path, config):
+    """Benchmarks only run when their directory is given, as in pytest tests/benchmarks"""
+    if collection_path.name == 'benchmarks' and not any('benchmarks' in str(arg) for arg in config.args):
+        return True
+
+
+def make_api_record(i, species_id=914):
+    """Returns a synthetic occurrence record with the same fields, in the same order, as the NAS API"""
+    return {
+        'key': 100000 + i,
+        'speciesID': species_id,
+        'group': 'Fishes',
+        'family': 'Salmonidae',
+        'genus': 'Oncorhynchus',
+        'species': 'mykiss',
+        'scientificName': 'Oncorhynchus mykiss',
+        'commonName': 'rainbow trout',
+        'state': 'MT',
+        'county': 'Lincoln',
+        'locality': f"Creek {i}",
+        'decimalLatitude': 48.0 + (i % 100) / 100,
+        'decimalLongitude': -115.0 + (i % 100) / 100,
+        'latLongSource': 'Map derived',
+        'latLongAccuracy': 'Accurate',
+        'centroidType': None,
+        'huc8Name': 'Fisher',
+        'huc8': '17010102',
+        'huc10Name': None,
+        'huc10': None,
+        'huc12Name': None,
+        'huc12': None,
+        'date': None,
+        'year': 1990 + i % 30,
+        'month': 1 + i % 12,
+        'day': 1 + i % 28,
+        'status': 'stocked',
+        'comments': None,
+        'recordType': 'Literature',
+        'disposal': None,
+        'museumCatNumber': None,
+        'freshMarineIntro': 'Freshwater',
+        'references': [
+            {'key': 24224 + i % 3, 'refType': 'Database', 'year': 2012,
+             'author': 'Montana Fish, Parks, and Wildlife.',
+             'title': 'Montana Fisheries Information System (MFISH).',
+             'publisher': 'Montana Fish, Parks, and Wildlife', 'publisherLocation': None},
+        ],
+    }
+
+
+def make_species_record(species_id, genus, species, common_name):
+    """Returns a synthetic species record with the fields of the NAS API"""
+    return {'speciesID': species_id, 'itis_tsn': None, 'group': 'Fishes', 'family': None, 'genus': genus,
+            'species': species, 'subspecies': '', 'variety': '', 'authority': None, 'common_name': common_name,
+            'native_exotic': 'Exotic', 'Fresh/Marine/Brackish': 'Freshwater'}
+
+
+def make_nas_csv(path, rows):
+    """Writes a synthetic NAS CSV file with rows records, in the layout of the demo file and drawn from its records.
+    Records get unique specimen numbers and references get keys spread over a few thousand values"""
+    demo = pd.read_csv(DEMO_CSV, dtype=str, keep_default_na=False)
+    df = demo.sample(rows, replace=True, random_state=0).reset_index(drop=True)
+    df['Specimen Number'] = (df.index + 1).astype(str)
+    shift = (df.index % 50) * 100000
+    for i in range(nas.REF_BLOCKS):
+        keys = pd.to_numeric(df[f"Reference {i+1}"])
+        df[f"Reference {i+1}"] = (keys + shift).astype('Int64').astype(str).replace('<NA>', '')
+    df.to_csv(path, index=False)
+    return path
+
+
+def make_ee_export(path, rows=100):
+    """Writes a synthetic Earth Engine CSV export and returns its dataframe. Exports have one 'system:index' prefix per
+    image, made unique with a row suffix"""
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({'system:index': [f"{2002 + i * 4 // rows:04d}_01_01_{i:05d}" for i in range(rows)],
+                       'huc12': rng.randint(10**11, 10**12, rows),
+                       'Elevation': rng.normal(size=rows),
+                       'Slope': rng.normal(size=rows),
+                       '.geo': '{}'})
+    df.to_csv(path, index=False)
+    return df
+
+
+class NasStub:
+    """State of the stub server: the records it serves and a log of the requests it received"""
+
+    def __init__(self, records):
+        self.records = records
+        self.species = [make_species_record(914, 'Oncorhynchus', 'mykiss', 'rainbow trout'),
+                        make_species_record(5, 'Dreissena', 'polymorpha', 'zebra mussel'),
+                        make_species_record(95, 'Dreissena', 'rostriformis bugensis', 'quagga mussel')]
+        self.requests = []
+        self.fail = 0
+        self.include_count = True
+        self.lock = threading.Lock()
+
+
+def _make_handler(stub):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            with stub.lock:
+                stub.requests.append((url.path, query))
+                failing = stub.fail > 0
+                if failing:
+                    stub.fail -= 1
+            if failing:
+                self.send_response(503)
+                self.end_headers()
+                return
+
+            if url.path.endswith('/occurrence/search'):
+                records = [r for r in stub.records if str(r['speciesID']) == query.get('species_ID', str(r['speciesID']))]
+                offset = int(query.get('offset', 0))
+                limit = int(query.get('limit', -1))
+                page = records[offset:] if limit < 0 else records[offset:offset + limit]
+                body = {'results': page}
+                if stub.include_count:
+                    body['count'] = len(records)
+            elif url.path.endswith('/species/search'):
+                body = {'results': [s for s in stub.species
+                                    if s['genus'] == query.get('genus', s['genus']) and s['species'] == query.get('species', s['species'])]}
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def nas_stub(monkeypatch, tmp_path):
+    """Serves synthetic NAS API responses from a local HTTP server and points nas.URL_BASE at it, with the species
+    catalog snapshot kept in a temporary directory"""
+    stub = NasStub([make_api_record(i) for i in range(2500)])
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(stub))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(nas, 'URL_BASE', f"http://127.0.0.1:{server.server_address[1]}/")
+    monkeypatch.setattr(nas.time, 'sleep', lambda seconds: None)
+    monkeypatch.setitem(catalog._settings, 'path', str(tmp_path / 'species.json.gz'))
+    monkeypatch.setattr(catalog, '_catalogs', {})
+    yield stub
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from flbs_ais import cache, nas
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+
+@pytest.fixture
+def local_cache(tmp_path):
+    cache.enable(str(tmp_path / 'cache.sqlite'))
+    yield cache
+    cache.disable()
+
+
+def test_cache_key_ignores_api_key(local_cache):
+    cache.put('http://nas/occurrence/search', {'species_ID': 5, 'api_key': 'a'}, {'results': [1]})
+    assert cache.get('http://nas/occurrence/search', {'species_ID': 5, 'api_key': 'b'}) == {'results': [1]}
+    assert cache.get('http://nas/occurrence/search', {'species_ID': 6}) is None
+
+
+def test_cache_ttl_and_eviction(local_cache, tmp_path, monkeypatch):
+    # Random text barely compresses, so each response takes about 200 bytes and only two fit
+    cache.enable(str(tmp_path / 'cache.sqlite'), ttl=10, max_bytes=500)
+    clock = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: clock[0])
+
+    cache.put('u', {'page': 0}, {'results': os.urandom(150).hex()})
+    clock[0] += 5
+    cache.put('u', {'page': 1}, {'results': os.urandom(150).hex()})
+    clock[0] += 1
+    assert cache.get('u', {'page': 0}) is not None
+
+    # Page 1 is now the least recently used, so it is evicted first
+    clock[0] += 1
+    cache.put('u', {'page': 2}, {'results': os.urandom(150).hex()})
+    assert cache.get('u', {'page': 1}) is None
+    assert cache.get('u', {'page': 2}) is not None
+
+    # Expired responses are fetched again, except in offline mode
+    clock[0] += 20
+    cache.enable(str(tmp_path / 'cache.sqlite'), ttl=10, offline=True)
+    assert cache.get('u', {'page': 2}) is not None
+    cache.enable(str(tmp_path / 'cache.sqlite'), ttl=10)
+    assert cache.get('u', {'page': 2}) is None
+
+
+def test_cached_api_requests(local_cache, nas_stub, tmp_path):
+    first = nas.api_df(914, -1, 'key-1', page_size=1000)
+    assert len(nas_stub.requests) == 3
+    second = nas.api_df(914, -1, 'key-2', page_size=1000)
+    assert len(nas_stub.requests) == 3
+    assert second['specimennumber'].equals(first['specimennumber'])
+
+    assert nas.species('Dreissena', 'polymorpha')[0]['speciesID'] == 5
+    assert nas.species('Dreissena', 'polymorpha', refresh=True)[0]['speciesID'] == 5
+    assert len(nas_stub.requests) == 5
+
+    cache.enable(str(tmp_path / 'cache.sqlite'), offline=True)
+    assert len(nas.api_df(914, -1, None, page_size=1000)) == 2500
+    with pytest.raises(LookupError):
+        nas.api_df(5, -1, None, page_size=1000)
+    assert len(nas_stub.requests) == 5
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from conftest import make_species_record
+from flbs_ais import catalog, nas
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+
+@pytest.fixture
+def local_catalog(tmp_path, monkeypatch):
+    monkeypatch.setitem(catalog._settings, 'path', str(tmp_path / 'species.json.gz'))
+    monkeypatch.setattr(catalog, '_catalogs', {})
+    yield catalog
+
+
+def test_find(local_catalog):
+    index = catalog.save([make_species_record(914, 'Oncorhynchus', 'mykiss', 'rainbow trout'),
+                          make_species_record(5, 'Dreissena', 'polymorpha', 'zebra mussel'),
+                          make_species_record(95, 'Dreissena', 'rostriformis bugensis', 'quagga mussel'),
+                          make_species_record(2, 'Dreissenid', 'sp.', 'dreissenid mussels')])
+    assert [r['speciesID'] for r in index.find(genus='Dreissena')] == [5, 95]
+    assert index.find(genus='dreissena') == []
+    assert [r['speciesID'] for r in index.find(genus='dreiss', prefix=True, ignore_case=True)] == [5, 95, 2]
+    assert [r['speciesID'] for r in index.find(genus='Dreiss', species='rostri', prefix=True)] == [95]
+    assert [r['speciesID'] for r in index.find(common_name='RAINBOW TROUT', ignore_case=True)] == [914]
+    assert [r['speciesID'] for r in index.find(species_id='5')] == [5]
+    assert len(index.find()) == len(index) == 4
+
+    # Snapshots are read back from the file once and kept in memory
+    catalog._catalogs.clear()
+    loaded = catalog.load()
+    assert loaded.records == index.records
+    assert catalog.load() is loaded
+
+
+def test_species(nas_stub):
+    assert [r['speciesID'] for r in nas.species('Dreissena', 'polymorpha')] == [5]
+    assert nas.species('oncorhynchus', 'MYKISS', output='string').startswith('speciesID: 914\n')
+    assert len(nas_stub.requests) == 1
+
+    # Blank names match any, as in the NAS API
+    assert [r['speciesID'] for r in nas.species('Dreissena', '')] == [5, 95]
+    assert len(nas.species('', '')) == 3
+
+    nas_stub.species.append(make_species_record(6, 'Dreissena', 'polymorpha', 'zebra mussel'))
+    assert len(nas.species('Dreissena', 'polymorpha')) == 1
+    assert len(nas.species('Dreissena', 'polymorpha', refresh=True)) == 2
+    assert len(nas_stub.requests) == 2
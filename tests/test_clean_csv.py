@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import pytest
+
+from conftest import make_ee_export
+from flbs_ais import clean_csv
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+
+def test_clean_csv_chunks(tmp_path):
+    filename = str(tmp_path / 'export.csv')
+    make_ee_export(filename)
+    options = {'keep_columns': ['system:index', 'huc12', 'elevation', 'Slope'], 'rename_columns': {'Elevation': 'elevation'},
+               'split_columns': ['elevation', 'Slope']}
+    eager = clean_csv.clean_csv(filename, **options)
+    assert sorted(eager) == [str(tmp_path / 'export_Slope.csv'), str(tmp_path / 'export_elevation.csv')]
+    slope = eager[str(tmp_path / 'export_elevation.csv')]
+    assert list(slope.columns) == ['system:index', 'huc12', 'Slope']
+    assert list(slope['system:index'].unique()) == [2002, 2003, 2004, 2005]
+
+    # Years follow first appearance across chunks, and every split file is written in the same pass
+    chunked = clean_csv.clean_csv(filename, chunksize=30, **options)
+    for key in eager:
+        pd.testing.assert_frame_equal(chunked[key], eager[key])
+    clean_csv.clean_csv(filename, output='csv', chunksize=30, **options)
+    for key in eager:
+        pd.testing.assert_frame_equal(pd.read_csv(key), eager[key])
+
+    with pytest.raises(ValueError):
+        clean_csv.clean_csv(filename, split_columns=['aspect'], chunksize=30)
+
+
+def test_clean_csv_projection(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'export.csv')
+    make_ee_export(filename)
+    read_columns = []
+    read_csv = pd.read_csv
+    monkeypatch.setattr(pd, 'read_csv', lambda *args, **kwargs: read_columns.append(kwargs.get('usecols')) or read_csv(*args, **kwargs))
+    df = clean_csv.clean_csv(filename, keep_columns=['huc12', 'elevation'], rename_columns={'Elevation': 'elevation'})
+    assert list(df[str(tmp_path / 'export_clean.csv')].columns) == ['huc12', 'elevation']
+    assert read_columns[-1] == ['huc12', 'Elevation']
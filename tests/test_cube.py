@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from flbs_ais.cube import HucCube
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+
+def _records(n, seed=0):
+    rng = np.random.RandomState(seed)
+    huc12 = pd.array(rng.choice([31401010101, 31401010102, 31401020301, 171001020304], n), dtype='Int64')
+    huc12[::17] = pd.NA
+    year = pd.array(rng.randint(1990, 2000 + seed, n), dtype='Int16')
+    status = pd.Categorical(rng.choice(['established', 'collected', 'failed', None], n))
+    return pd.DataFrame({'huc12': huc12, 'year': year, 'status': status})
+
+
+def _groupby(df, by):
+    return df.dropna(subset=['huc12', 'year', 'status']).astype({'status': str}).groupby(by).size()
+
+
+def test_cube_matches_groupby():
+    df = _records(3000)
+    cube = HucCube(df)
+    assert len(cube) == len(df.dropna())
+
+    expected = _groupby(df, ['huc12', 'year', 'status'])
+    assert cube.to_series().to_dict() == expected.to_dict()
+    assert cube.to_series(by=['year', 'huc']).to_dict() == _groupby(df, ['year', 'huc12']).to_dict()
+    assert cube.to_series(by='status').to_dict() == _groupby(df, 'status').to_dict()
+
+    assert cube.count(huc=31401010101, year=slice(1992, 1994), status=['failed', 'unknown']) == \
+        expected.loc[31401010101, [1992, 1993, 1994], 'failed'].sum()
+    assert cube.count(huc=12345) == 0
+
+    huc8 = df.assign(huc8=df['huc12'] // 10000)
+    rolled = cube.rollup('huc8')
+    assert list(rolled.hucs) == [3140101, 3140102, 17100102]
+    assert rolled.to_series(by=['huc', 'year']).to_dict() == \
+        huc8.dropna(subset=['huc12', 'year', 'status']).groupby(['huc8', 'year']).size().to_dict()
+    with pytest.raises(ValueError):
+        rolled.rollup('huc10')
+
+
+def test_add():
+    first, second = _records(1000, seed=1), _records(1000, seed=4)
+    cube = HucCube(first)
+    cube.add(second)
+    whole = HucCube(pd.concat([first, second], ignore_index=True))
+    assert list(cube.years) == list(range(1990, 2004))
+    assert np.array_equal(cube.counts, whole.counts)
+    assert cube.to_series().to_dict() == _groupby(pd.concat([first, second]), ['huc12', 'year', 'status']).to_dict()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from flbs_ais import feature_importance
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+
+def _make_features(n=300):
+    rng = np.random.RandomState(0)
+    X = pd.DataFrame({'elevation': rng.normal(size=n), 'slope': rng.normal(size=n), 'precip': rng.normal(size=n)})
+    X['temperature'] = -X['elevation'] + rng.normal(scale=0.05, size=n)
+    y = pd.Series(rng.normal(size=n))
+    return X, y
+
+
+def test_feature_dependence_matrix(monkeypatch):
+    X, y = _make_features()
+    feature_importance._dependence_cache.clear()
+    serial = feature_importance.feature_dependence_matrix(X, n_estimators=10, workers=1)
+    assert serial.loc['temperature', 'elevation'] > 0.5
+    assert serial.loc['slope', 'slope'] == 1
+
+    # Rows come from the cache unless their columns changed
+    calls = []
+    row = feature_importance._get_dependence_row
+    monkeypatch.setattr(feature_importance, '_get_dependence_row', lambda *args: calls.append(args[1]) or row(*args))
+    pd.testing.assert_frame_equal(feature_importance.feature_dependence_matrix(X, n_estimators=10, workers=1), serial)
+    assert calls == []
+    X_changed = X.assign(precip=X['precip'] * 2)
+    feature_importance.feature_dependence_matrix(X_changed, n_estimators=10, workers=1)
+    assert sorted(calls) == sorted(X.columns)
+    monkeypatch.undo()
+
+    feature_importance._dependence_cache.clear()
+    parallel = feature_importance.feature_dependence_matrix(X, n_estimators=10, workers=2)
+    pd.testing.assert_frame_equal(parallel, serial)
+
+
+def test_remove_partial_dependencies():
+    X, y = _make_features()
+    dropped = []
+    kept = feature_importance.remove_partial_dependencies(X, y, 0.5, interactive=False, dropped_list=dropped, workers=2)
+    assert len(dropped) == 1 and dropped[0] in ('elevation', 'temperature')
+    assert sorted(kept.columns) == sorted(set(X.columns) - set(dropped))
+
+
+def test_prune_dependencies(monkeypatch):
+    X, y = _make_features()
+    X['heat'] = X['temperature'] + X['slope'] * 0.01
+    kept, dropped = feature_importance.prune_dependencies(X, y, 0.5)
+    assert list(dropped.columns) == ['feature', 'partner', 'dependence', 'pairs']
+    assert list(dropped['dependence']) == sorted(dropped['dependence'], reverse=True)
+    assert len(dropped) == 2 and (dropped['dependence'] >= 0.5).all()
+    assert sorted(kept.columns) == sorted(set(X.columns) - set(dropped['feature']))
+    assert {'slope', 'precip'} <= set(kept.columns)
+
+    # Coverage drops the feature in the most dependent pairs first
+    kept, dropped = feature_importance.prune_dependencies(X, y, 0.5, strategy='coverage')
+    assert len(dropped) == 2 and dropped['pairs'][0] >= dropped['pairs'][1]
+
+    with pytest.raises(ValueError):
+        feature_importance.prune_dependencies(X, y, 0.5, strategy='lowest')
+
+
+def test_prune_dependencies_confirm():
+    X, y = _make_features()
+    X['heat'] = X['temperature'] + X['slope'] * 0.01
+    exact = feature_importance.prune_dependencies(X, y, 0.5)[1]
+    # The linear estimator picks other features, confirming its rows gives the drops of the exact method
+    assert list(feature_importance.prune_dependencies(X, y, 0.5, method='linear')[1]['feature']) != list(exact['feature'])
+    kept, dropped = feature_importance.prune_dependencies(X, y, 0.5, method='linear', confirm=True)
+    pd.testing.assert_frame_equal(dropped, exact)
+
+    dropped_list = []
+    feature_importance.remove_partial_dependencies(X, y, 0.5, interactive=False, dropped_list=dropped_list, method='linear',
+                                                   confirm=True)
+    assert dropped_list == list(exact['feature'])
+
+
+def test_prune_dependencies_random_state():
+    X, y = _make_features()
+    X['heat'] = X['temperature'] + X['slope'] * 0.01
+    # Rows are computed with their own random state, the global one is left as it was
+    np.random.seed(0)
+    expected = np.random.random()
+    np.random.seed(0)
+    feature_importance.prune_dependencies(X, y, 0.5, workers=1)
+    assert np.random.random() == expected
+
+
+def test_get_partial_dependencies_pairs(monkeypatch):
+    names = ['a', 'b', 'c', 'd']
+    matrix = pd.DataFrame([[0.9, 1.0, 0.7, 0.2, 0.0],
+                           [0.8, 0.3, 1.0, 0.9, 0.1],
+                           [0.5, 0.6, 0.8, 1.0, np.nan],
+                           [np.nan, np.nan, np.nan, np.nan, np.nan]],
+                          index=names, columns=['Dependence'] + names)
+    monkeypatch.setattr(feature_importance, 'feature_dependence_matrix', lambda X, **kwargs: matrix)
+    X, y = _make_features()
+    pairs = feature_importance._get_partial_dependencies(X, y, 0.5)
+    assert list(pairs.columns) == ['index', 'variable', 'value']
+    assert [tuple(row) for row in pairs.values] == [('b', 'c', 0.9), ('a', 'b', 0.7), ('c', 'a', 0.6)]
+    assert feature_importance._get_partial_dependencies(X, y, 0.95).empty
+
+
+def test_linear_dependence_matrix():
+    X, y = _make_features()
+    X['constant'] = 1.0
+    matrix = feature_importance.linear_dependence_matrix(X)
+    assert list(matrix.columns) == ['Dependence'] + list(X.columns)
+    assert matrix.loc['temperature', 'elevation'] > 0.9 and matrix.loc['elevation', 'temperature'] > 0.9
+    assert matrix.loc['slope', 'precip'] < 0.05
+    assert matrix.loc['elevation', 'Dependence'] > 0.9 and matrix.loc['slope', 'Dependence'] < 0.05
+
+
+@pytest.mark.parametrize('method', ['subsample', 'forest', 'linear'])
+def test_get_partial_dependencies_methods(method):
+    X, y = _make_features()
+    pairs = feature_importance._get_partial_dependencies(X, y, 0.5, method=method, fraction=0.5)
+    assert {frozenset(pair) for pair in zip(pairs['index'], pairs['variable'])} == {frozenset(['elevation', 'temperature'])}
+    confirmed = feature_importance._get_partial_dependencies(X, y, 0.5, method=method, fraction=0.5, confirm=True)
+    exact = feature_importance._get_partial_dependencies(X, y, 0.5)
+    pd.testing.assert_frame_equal(confirmed, exact)
+
+    with pytest.raises(ValueError):
+        feature_importance._get_partial_dependencies(X, y, 0.5, method='fast')
+
+
+def test_remove_partial_dependencies_interactive(monkeypatch):
+    X, y = _make_features()
+    feature_importance._dependence_cache.clear()
+    answers = iter(['1', 'y'])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(answers))
+    calls = []
+    row = feature_importance._get_dependence_row
+    monkeypatch.setattr(feature_importance, '_get_dependence_row', lambda *args: calls.append(args[1]) or row(*args))
+
+    dropped = []
+    kept = feature_importance.remove_partial_dependencies(X, y, 0.5, dropped_list=dropped, workers=1)
+    assert len(dropped) == 1 and dropped[0] in ('elevation', 'temperature')
+    assert list(kept.columns) == [col for col in X.columns if col not in dropped]
+
+    # After the drop, only rows of features that depended on the dropped feature are computed again
+    matrix = feature_importance.feature_dependence_matrix(
+        feature_importance.train_test_split(X, y, test_size=0.2, random_state=1)[0], workers=1)
+    affected = [col for col in X.columns if col != dropped[0] and matrix.loc[col, dropped[0]] > 0]
+    assert sorted(calls[len(X.columns):]) == sorted(affected)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+
+import pytest
+
+from conftest import DEMO_CSV
+from flbs_ais import instrument, nas
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+
+def test_record_csv_df(caplog):
+    with instrument.record(memory=True) as recorder:
+        nas.modify_df(nas.csv_df(DEMO_CSV), refs=[24224], earth=True)
+    assert not instrument.is_enabled()
+
+    totals = recorder.as_dict()
+    assert list(totals) == ['read_csv', 'columns', 'convert_refs', 'schema', 'ref_filter', 'make_date_col']
+    assert totals['read_csv']['rows'] == 33 and totals['ref_filter']['rows'] == 28
+    assert all(total['calls'] == 1 and total['seconds'] > 0 and total['peak_bytes'] >= 0 for total in totals.values())
+
+    with caplog.at_level(logging.INFO, logger='flbs_ais'):
+        recorder.log()
+    assert [json.loads(message)['stage'] for message in caplog.messages] == list(totals)
+    assert caplog.records[0].rows == 33
+
+
+def test_record_api_df(nas_stub):
+    with instrument.record() as recorder:
+        nas.api_df(914, -1, None, page_size=1000)
+    totals = recorder.as_dict()
+    assert totals['http']['calls'] == 3 and totals['json_decode']['rows'] == 2500
+    assert totals['http']['peak_bytes'] is None
+
+
+def test_disabled():
+    assert instrument.stage('read_csv') is instrument.stage('schema')
+    with instrument.stage('read_csv') as entry:
+        entry['rows'] = 1
+    with instrument.record():
+        with pytest.raises(RuntimeError):
+            with instrument.record():
+                pass
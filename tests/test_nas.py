@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+import math
+import os
+
+import pandas as pd
+import pytest
+import requests
+
+from conftest import make_api_record
+from flbs_ais import nas
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+DEMO_CSV = os.path.join(os.path.dirname(__file__), '..', 'demo', 'NAS_data_914.csv')
+
+
+def test_api_df_pages(nas_stub):
+    df = nas.api_df(914, -1, None, page_size=1000)
+    assert list(df.columns) == nas.get_header()
+    assert len(df) == 2500
+    assert list(df.specimennumber) == [r['key'] for r in nas_stub.records]
+    offsets = sorted(int(q['offset']) for p, q in nas_stub.requests)
+    assert offsets == [0, 1000, 2000]
+
+
+def test_api_df_limit(nas_stub):
+    df = nas.api_df(914, 1500, 'secret', page_size=1000)
+    assert len(df) == 1500
+    assert sorted(int(q['limit']) for p, q in nas_stub.requests) == [500, 1000]
+    assert all(q['api_key'] == 'secret' for p, q in nas_stub.requests)
+
+
+def test_api_df_pages_without_count(nas_stub):
+    nas_stub.include_count = False
+    df = nas.api_df(914, -1, None, page_size=1000)
+    assert len(df) == 2500
+    assert len(nas_stub.requests) == 3
+
+
+def test_api_df_retries(nas_stub):
+    nas_stub.fail = 2
+    df = nas.api_df(914, 10, None)
+    assert len(df) == 10
+    assert len(nas_stub.requests) == 3
+
+    nas_stub.fail = nas.MAX_RETRIES + 1
+    with pytest.raises(requests.HTTPError):
+        nas.api_df(914, 10, None)
+
+
+def test_api_df_timeout(nas_stub, monkeypatch):
+    # Every request has a timeout, and a request that times out is retried
+    monkeypatch.setattr(nas, '_session', None)
+    monkeypatch.setattr(nas, '_pool_size', 0)
+    session = nas._get_session()
+    get, timeouts = session.get, []
+
+    def stalled_get(url, params=None, timeout=None):
+        timeouts.append(timeout)
+        if len(timeouts) == 1:
+            raise requests.Timeout()
+        return get(url, params=params, timeout=timeout)
+
+    monkeypatch.setattr(session, 'get', stalled_get)
+    assert len(nas.api_df(914, 2500, None, page_size=1000, workers=12)) == 2500
+    assert timeouts == [nas.TIMEOUT] * 4
+    assert session.get_adapter(nas.URL_BASE)._pool_maxsize == 12
+
+
+def test_api_df_transform(nas_stub, monkeypatch):
+    # Each page is normalized once, as soon as it arrives rather than after every page is fetched
+    normalize, seen = nas._normalize_api, []
+
+    def counting_normalize(records, float32_coords=False):
+        seen.append((len(records), len(nas_stub.requests)))
+        return normalize(records, float32_coords)
+
+    monkeypatch.setattr(nas, '_normalize_api', counting_normalize)
+    df = nas.api_df(914, -1, None, page_size=1000, workers=1)
+    assert len(df) == 2500
+    assert seen == [(1000, 1), (1000, 2), (500, 3)]
+
+
+def test_concat_df_pages():
+    records = [make_api_record(i) for i in range(6)]
+    # Pages with different categories, and columns that are all null in one page only
+    for i, record in enumerate(records):
+        record.update(status='stocked' if i < 3 else 'established', state='MT' if i % 2 else 'ID')
+        if i >= 3:
+            record.update(huc10='1701010201', huc10Name='Upper Fisher', centroidType='Stream')
+    single = nas._normalize_api(records)
+    joined = nas.concat_df([nas._normalize_api(records[:3]), nas._normalize_api(records[3:])]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(joined.drop(columns='references'), single.drop(columns='references'))
+    assert _same_refs(joined['references'], single['references'])
+
+
+def test_concat_df_columns():
+    # Columns of any dataframe are kept, and are null in the dataframes without them
+    joined = nas.concat_df([pd.DataFrame({'x': [1]}), pd.DataFrame({'x': [3], 'y': [4]})])
+    assert list(joined.columns) == ['x', 'y']
+    assert list(joined['x']) == [1, 3] and joined['y'].isna().tolist() == [True, False]
+
+    df = nas.csv_df(DEMO_CSV)
+    joined = nas.concat_df([df, nas.modify_df(df, earth=True)])
+    assert list(joined.columns) == nas.get_header() + ['dateprecision']
+    assert joined['dateprecision'][:len(df)].isna().all()
+    assert joined['dateprecision'][len(df):].notna().any()
+
+
+def _convert_refs_loop(df):
+    # Row by row conversion that _convert_refs replaced, kept as the reference behaviour
+    ref_list_of_lists = []
+    for row in df.itertuples():
+        ref_list = []
+        for j in range(6):
+            ref_dict = {}
+            ref_dict['key'] = int(row[35 + j * 7]) if not math.isnan(row[35 + j * 7]) else math.nan
+            if not math.isnan(ref_dict['key']):
+                ref_dict['refType']           = row[36 + j * 7]
+                ref_dict['year']              = int(row[37 + j * 7]) if not math.isnan(row[37 + j * 7]) else math.nan
+                ref_dict['author']            = row[38 + j * 7]
+                ref_dict['title']             = row[39 + j * 7]
+                ref_dict['publisher']         = row[40 + j * 7]
+                ref_dict['publisherLocation'] = row[41 + j * 7]
+                ref_list.append(ref_dict)
+            else:
+                break
+        ref_list_of_lists.append(ref_list)
+    return ref_list_of_lists
+
+
+def _same_refs(left, right):
+    # NaN fields never compare equal, so compare their string forms instead
+    return [repr(refs) for refs in left] == [repr(refs) for refs in right]
+
+
+def test_convert_refs_matches_loop(monkeypatch):
+    frames = []
+    monkeypatch.setattr(nas, '_convert_refs', lambda df: frames.append(df.copy()) or df)
+    monkeypatch.setattr(nas, '_apply_schema', lambda df, float32_coords=False: df)
+    nas.csv_df(DEMO_CSV)
+    monkeypatch.undo()
+    df = frames[0]
+
+    # A gap in the blocks ends the reference list, and a missing date stays NaN
+    df.loc[0, 'reference3'] = 99
+    df.loc[1, 'reference1'] = 77
+    df.loc[1, 'date1'] = math.nan
+
+    expected = _convert_refs_loop(df)
+    converted = nas._convert_refs(df.copy())
+    assert list(converted.columns) == nas.get_header()
+    assert list(nas._apply_schema(converted).dtypes.astype(str)) == list(nas.get_schema().values())
+    assert _same_refs(converted['references'], expected)
+    assert converted['references'][0][0]['key'] == 24224
+    assert math.isnan(converted['references'][1][0]['year'])
+
+
+def test_modify_df_refs():
+    df = nas.csv_df(DEMO_CSV)
+    filtered = nas.modify_df(df, refs=[24224])
+    assert len(filtered) == 28
+    assert all(refs[0]['key'] == 24224 for refs in filtered['references'])
+    assert nas.references(df)[0][1] == 28
+
+
+def test_references():
+    df = nas.csv_df(DEMO_CSV)
+    ranked = nas.references(df)
+    assert [count for refs, count in ranked] == sorted((count for refs, count in ranked), reverse=True)
+    assert nas.references(df, limit=2) == ranked[:2]
+    assert nas.references(df, ascending=False, limit=2) == ranked[::-1][:2]
+
+    titles = [refs[0]['title'].lower() for refs, count in nas.references(df, sort='alphabet')]
+    assert titles == sorted(titles)
+
+    report = nas.references(df, output='string', ascending=False, limit=1)
+    assert report.startswith(f"--------\nMost common reference {len(ranked)}\n")
+    assert report.count('Source number:      1\n') == 1
+    assert report.endswith(f"Total Occurrences:  {ranked[-1][1]}\n--------\n\n")
+
+
+def test_modify_df_ref_match():
+    df = nas.csv_df(DEMO_CSV)
+    # Key 13010 is only ever the second reference of a record
+    assert len(nas.modify_df(df, refs=[13010])) == 0
+    both = nas.modify_df(df, refs=[13010, 24224], ref_match='any')
+    assert len(both) == 30
+    assert list(both.index) == sorted(both.index)
+
+    # The key index is built once and reused by later calls on the same frame
+    index = df['references'].array._key_index['any']
+    nas.modify_df(df, refs=[360], ref_match='any')
+    assert df['references'].array._key_index['any'] is index
+
+    with pytest.raises(ValueError):
+        nas.modify_df(df, refs=[360], ref_match='all')
+
+
+def test_csv_df_chunks(tmp_path):
+    raw = pd.read_csv(DEMO_CSV, dtype=str)
+    raw = pd.concat([raw] * 4, ignore_index=True)
+    # A text column that only looks numeric in some chunks
+    raw.loc[100:, 'Museum_Cat_No'] = 'MT-' + raw.index[100:].astype(str)
+    raw.loc[:99, 'Museum_Cat_No'] = '1234'
+    filename = tmp_path / 'nas.csv'
+    raw.to_csv(filename, index=False)
+
+    eager = nas.csv_df(filename)
+    chunks = list(nas.csv_df(filename, chunksize=50))
+    assert len(chunks) == 3
+    streamed = nas.concat_df(chunks)
+    pd.testing.assert_frame_equal(streamed.drop(columns='references'), eager.drop(columns='references'))
+    assert _same_refs(streamed['references'], eager['references'])
+
+
+def test_schema(nas_stub):
+    schema = nas.get_schema(float32_coords=True)
+    assert list(schema) == nas.get_header()
+    for df in (nas.csv_df(DEMO_CSV, float32_coords=True), nas.api_df(914, 100, None, float32_coords=True)):
+        assert list(df.dtypes.astype(str)) == list(schema.values())
+    assert nas.api_df(914, 1, None)['huc8'][0] == 17010102
+
+
+def test_column_sources():
+    assert list(nas._COLUMN_SOURCES) == nas.get_header()
+
+    # Columns are found by name, so field order and extra fields in API records don't change the layout
+    records = [make_api_record(i) for i in range(5)]
+    shuffled = [dict(reversed(list(record.items())), extraField=i) for i, record in enumerate(records)]
+    expected = nas._normalize_api(records)
+    normalized = nas._normalize_api(shuffled)
+    pd.testing.assert_frame_equal(normalized.drop(columns='references'), expected.drop(columns='references'))
+    assert _same_refs(normalized['references'], expected['references'])
+
+
+@pytest.mark.parametrize('out', [nas.feather_out, nas.parquet_out])
+def test_binary_round_trip(out, tmp_path, nas_stub):
+    pytest.importorskip('pyarrow')
+    for df in (nas.csv_df(DEMO_CSV, float32_coords=True), nas.api_df(914, 50, None)):
+        out(df, filepath=f"{tmp_path}/")
+        filename = str(next(p for p in tmp_path.iterdir()))
+        reloaded = nas.read_df(filename)
+        pd.testing.assert_frame_equal(reloaded.drop(columns='references'), df.drop(columns='references'))
+        assert reloaded['references'].dtype == df['references'].dtype
+        assert _same_refs(reloaded['references'], df['references'])
+
+        projected = nas.read_df(filename, columns=['specimennumber', 'references'])
+        assert list(projected.columns) == ['specimennumber', 'references']
+        assert _same_refs(projected['references'], df['references'])
+        os.remove(filename)
+
+
+def test_sync_df(tmp_path, nas_stub):
+    pytest.importorskip('pyarrow')
+    store = str(tmp_path / 'nas.feather')
+    df = nas.sync_df(914, store, page_size=1000)
+    assert len(df) == 2500
+    pd.testing.assert_frame_equal(nas.read_df(store), df)
+
+    # Only the last partial page and the pages after it are requested again
+    nas_stub.records += [make_api_record(i) for i in range(2500, 3200)]
+    nas_stub.requests.clear()
+    df = nas.sync_df(914, store, page_size=1000)
+    assert sorted(int(q['offset']) for p, q in nas_stub.requests) == [2000, 3000]
+    assert list(df.specimennumber) == [r['key'] for r in nas_stub.records]
+
+    # Edits to earlier pages are only found when verifying, and replace the stored record
+    nas_stub.records[10]['locality'] = 'Edited'
+    assert nas.sync_df(914, store, page_size=1000)['locality'][10] == 'Creek 10'
+    df = nas.sync_df(914, store, page_size=1000, verify=True)
+    assert len(df) == 3200
+    assert df.set_index('specimennumber').loc[100010, 'locality'] == 'Edited'
+    assert df['specimennumber'].is_unique
+
+    # A store holds one species, so another species is refused and the store is left as it was
+    with pytest.raises(ValueError):
+        nas.sync_df(5, store, page_size=1000)
+    pd.testing.assert_frame_equal(nas.read_df(store), df)
+
+
+def test_batch_df(nas_stub):
+    nas_stub.records = nas_stub.records[:300] + [dict(r, speciesID=5) for r in nas_stub.records[300:500]]
+    df, report = nas.batch_df([914, '5', DEMO_CSV, 'missing.csv'], processes=2)
+    assert list(report.source) == [914, '5', DEMO_CSV, 'missing.csv']
+    assert list(report.records) == [300, 200, 33, 0]
+    assert report.error[:3].isna().all() and report.error[3].startswith('FileNotFoundError')
+    assert (report.seconds >= 0).all()
+
+    assert df.index.name == 'speciesid'
+    assert list(df.index.value_counts().sort_index().items()) == [(5, 200), (914, 333)]
+    assert list(df.columns) == [name for name in nas.get_header() if name != 'speciesid']
+    assert df['references'].dtype == nas.get_schema()['references']
+
+
+def test_csv_df_projection():
+    full = nas.csv_df(DEMO_CSV)
+    keep = ['specimennumber', 'genus', 'huc8', 'year', 'references']
+    projected = nas.csv_df(DEMO_CSV, keep=keep)
+    assert list(projected.columns) == keep
+    pd.testing.assert_frame_equal(projected.drop(columns='references'), full[keep].drop(columns='references'))
+    assert _same_refs(projected['references'], full['references'])
+    assert nas._csv_source_columns(keep) == ['Specimen Number', 'HUC 8 Number', 'Year'] + nas._csv_source_columns(['references'])
+
+    dropped = nas.csv_df(DEMO_CSV, drop=['references', 'locality'], chunksize=10)
+    assert list(nas.concat_df(dropped).columns) == [name for name in nas.get_header() if name not in ('references', 'locality')]
+    with pytest.raises(ValueError):
+        nas.csv_df(DEMO_CSV, drop=['habitat'])
+
+
+def test_make_date_col():
+    df = nas.csv_df(DEMO_CSV)
+    df.loc[0, 'day'] = pd.NA
+    df.loc[1, 'month'] = pd.NA
+    df.loc[2, 'year'] = pd.NA
+    df.loc[3, ['month', 'day']] = [2, 30]
+    original = df.copy()
+
+    earth = nas.modify_df(df, earth=True)
+    assert list(earth['date'][:5].astype(str)) == ['1996-08-01', '2002-01-01', 'NaT', '1993-02-01', '1993-09-01']
+    assert list(earth['dateprecision'][:5].astype(str)) == ['month', 'year', 'nan', 'month', 'day']
+    assert earth.columns.get_loc('dateprecision') == earth.columns.get_loc('date') + 1
+    pd.testing.assert_frame_equal(df.drop(columns='references'), original.drop(columns='references'))
+
+    kept = nas.modify_df(df, earth=True, keep=['specimennumber', 'date'])
+    assert list(kept.columns) == ['specimennumber', 'date']
+
+    # Keep and drop lists covering the columns given still combine when earth adds dateprecision
+    keep = ['specimennumber', 'date', 'year']
+    combined = nas.modify_df(df, earth=True, keep=keep, drop=[name for name in nas.get_header() if name not in keep])
+    assert list(combined.columns) == keep
+    assert 'dateprecision' not in nas.modify_df(df, earth=True, drop=['date'])
+    assert 'dateprecision' in nas.modify_df(df, earth=True, keep=['date', 'dateprecision'])
+
+    # Years that datetime64[ns] can't hold are missing instead of wrapping around
+    df.loc[:2, 'year'] = [1500, 2300, 1678]
+    earth = nas.modify_df(df, earth=True)
+    assert list(earth['date'][:3].astype(str)) == ['NaT', 'NaT', '1678-07-20']
+    assert list(earth['dateprecision'][:3].astype(str)) == ['nan', 'nan', 'day']
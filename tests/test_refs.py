@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import numpy as np
+import pandas as pd
+
+from flbs_ais.refs import RefArray, REF_FIELDS
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+
+def _ref(key, year=2012):
+    return {'key': key, 'refType': 'Database', 'year': year, 'author': f"Author {key}",
+            'title': f"Title {key}", 'publisher': 'USGS', 'publisherLocation': math.nan}
+
+
+def test_round_trip():
+    ref_lists = [[_ref(1), _ref(2)], [], [_ref(1), _ref(2)], [_ref(3, math.nan)], None]
+    array = RefArray._from_sequence(ref_lists)
+    assert len(array.table) == 3
+    assert list(array.table.columns) == REF_FIELDS
+    assert repr(list(array)[:4]) == repr(ref_lists[:4])
+    assert list(array.isna()) == [False, False, False, False, True]
+    assert list(array.first_keys()) == [1, -1, 1, 3, -1]
+
+
+def test_series_operations():
+    a = pd.Series(RefArray._from_sequence([[_ref(1)], [_ref(2)], [_ref(1)]]))
+    b = pd.Series(RefArray._from_sequence([[_ref(3)], [_ref(1)]]))
+    combined = pd.concat([a, b], ignore_index=True)
+    assert combined.dtype == a.dtype
+    assert [refs[0]['key'] for refs in combined] == [1, 2, 1, 3, 1]
+    assert len(combined.array.table) == 3
+
+    counts = combined.value_counts()
+    assert list(counts) == [3, 1, 1]
+    assert counts.index[0][0]['key'] == 1
+
+    assert [refs[0]['key'] for refs in combined[combined.index > 2]] == [3, 1]
+    assert list(combined.astype(str))[1] == repr([_ref(2)])
+
+
+def test_setitem():
+    array = RefArray._from_sequence([[_ref(1)], [_ref(2)]])
+    array[1] = [_ref(5), _ref(1)]
+    assert [ref['key'] for ref in array[1]] == [5, 1]
+    assert array[0][0]['key'] == 1
+    assert np.array_equal(array.first_keys(), [1, 5])
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from flbs_ais.spatial import SpatialIndex, _haversine
+
+__author__ = "Randy Flores"
+__copyright__ = "Randy Flores"
+__license__ = "mit"
+
+
+def _points(n, seed=0):
+    rng = np.random.RandomState(seed)
+    lat = rng.uniform(-90, 90, n)
+    lon = rng.uniform(-180, 180, n)
+    lat[::50] = np.nan
+    return pd.DataFrame({'specimennumber': np.arange(n) + seed * n, 'latitude': lat, 'longitude': lon})
+
+
+def test_queries_match_full_scan():
+    df = _points(5000)
+    index = SpatialIndex(df, cell_size=1)
+    lat, lon = df['latitude'], df['longitude']
+
+    for south, west, north, east in [(10, -20, 40, 35.5), (-90, 170, 90, -170), (25.2, 40, 25.9, 42)]:
+        inside = lat.between(south, north) & (lon.between(west, 180) | lon.between(-180, east) if west > east
+                                              else lon.between(west, east))
+        assert list(index.bbox(south, west, north, east)['specimennumber']) == list(df.loc[inside, 'specimennumber'])
+
+    for point, km in [((45.0, 179.5), 800), ((88.0, 0.0), 500), ((0.0, 0.0), 20000)]:
+        distances = pd.Series(_haversine(*point, lat, lon), index=df.index)
+        expected = distances[distances <= km].sort_values(kind='stable')
+        found = index.radius(*point, km)
+        assert list(found.index) == list(expected.index)
+        assert np.allclose(found['distance'], expected)
+        assert list(index.nearest(*point, k=7).index) == list(distances.sort_values(kind='stable').index[:7])
+
+
+def test_add():
+    first, second = _points(2000, seed=1), _points(2000, seed=2)
+    index = SpatialIndex(first)
+    index.add(second)
+    whole = SpatialIndex(pd.concat([first, second], ignore_index=True))
+    assert len(index) == len(whole) == 3920
+    assert list(index.bbox(-30, -60, 30, 60)['specimennumber']) == list(whole.bbox(-30, -60, 30, 60)['specimennumber'])
+    assert list(index.nearest(10, 10, k=5)['specimennumber']) == list(whole.nearest(10, 10, k=5)['specimennumber'])
+
+    with pytest.raises(ValueError):
+        index.bbox(40, 0, 10, 5)